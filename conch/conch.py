@@ -4,6 +4,7 @@ from __future__ import division
 import numpy as np
 import regex as re
 
+from functools import lru_cache
 from reach import Reach
 
 removal = re.compile(r"[\d]+\.\s", re.UNICODE)
@@ -63,7 +64,10 @@ def compose(documents,
             window,
             context_function,
             use_focus=True,
-            norm=False):
+            norm=False,
+            cache_size=None,
+            dtype=np.float32,
+            return_mask=False):
     """
     Map phrases from sentences to vectors.
 
@@ -85,16 +89,78 @@ def compose(documents,
         Whether to vectorize the focus word.
     norm : bool, optional, default False
         Whether to use the unit vectors to compose.
+    cache_size : int, optional, default None
+        If this is not None, composed vectors are memoized in a LRU cache
+        of this size, keyed on the tokens of the phrase and its context.
+        Repeated phrases are then only vectorized once.
+    dtype : numpy dtype, optional, default np.float32
+        The dtype in which the phrases are composed and stored. Embeddings
+        of another dtype are converted before composing.
+    return_mask : bool, optional, default False
+        Whether to also return a mask of the phrases with a nonzero vector.
+        The other phrases, e.g. which only contain OOV words, do not need
+        to be searched, see eval_extrinsic_label.
 
     Returns
     =======
     phrases : Reach
         A reach instance containing the phrases and their vectors.
+    mask : np.array
+        A boolean mask of the phrases with a nonzero vector. Only returned
+        if return_mask is True.
+
+    """
+    phrases, vectors, mask = [], [], []
+
+    for _, _, _, phrase_string, vector in iter_phrases(documents,
+                                                       embeddings,
+                                                       window,
+                                                       context_function,
+                                                       use_focus,
+                                                       norm,
+                                                       cache_size,
+                                                       dtype):
+
+        # Phrase string needs to be augmented with index to make
+        # the dictionary mapping not overwrite itself.
+        phrase_string = "{}-{}".format(phrase_string, len(phrases))
+        phrases.append(phrase_string)
+        vectors.append(vector)
+        mask.append(vector.any())
+
+    r = Reach(np.array(vectors, dtype=dtype), phrases)
+    if return_mask:
+        return r, np.array(mask, dtype=bool)
+
+    return r
+
+
+def iter_phrases(documents,
+                 embeddings,
+                 window,
+                 context_function,
+                 use_focus=True,
+                 norm=False,
+                 cache_size=None,
+                 dtype=np.float32):
+    """
+    Compose the phrases of a set of documents one at a time.
+
+    The parameters are the same as those of compose.
+
+    Returns
+    =======
+    phrases : generator
+        A generator of (document index, begin, end, phrase string, vector)
+        tuples, one for each chunk, in the order of the documents.
 
     """
     bio_regex = re.compile(r"BI*")
 
-    phrases, vectors = [], []
+    if cache_size is None:
+        vectorize = _vectorize_context
+    else:
+        vectorize = lru_cache(maxsize=cache_size)(_vectorize_context)
 
     for idx, (txt, bio) in enumerate(documents):
 
@@ -102,24 +168,32 @@ def compose(documents,
         bio = "".join([x.split("-")[0] for x in bio])
         for t in bio_regex.finditer(bio):
             b, e = t.span()
-            phrase_string, vector = create_phrase_vector(txt,
+            left_window, phrase, right_window = _windows(txt,
                                                          b,
                                                          e,
                                                          window,
-                                                         embeddings,
-                                                         np.mean,
-                                                         np.mean,
-                                                         context_function,
-                                                         use_focus,
-                                                         norm)
-
-            # Phrase string needs to be augmented with index to make
-            # the dictionary mapping not overwrite itself.
-            phrase_string = "{}-{}".format(phrase_string, len(phrases))
-            phrases.append(phrase_string)
-            vectors.append(vector)
-
-    return Reach(vectors, phrases)
+                                                         use_focus)
+            # Tuples, because the cache needs hashable keys.
+            vector = vectorize(tuple(phrase),
+                               tuple(left_window),
+                               tuple(right_window),
+                               embeddings,
+                               np.mean,
+                               np.mean,
+                               context_function,
+                               norm,
+                               dtype)
+            phrase_string = "{}-{}-{}".format(left_window[::-1],
+                                              phrase,
+                                              right_window)
+
+            yield idx, b, e, phrase_string, vector
+
+    if cache_size is not None:
+        info = vectorize.cache_info()
+        total = max(info.hits + info.misses, 1)
+        print("Phrase cache: {} hits, {} misses, hit rate {:.3f}".format(
+              info.hits, info.misses, info.hits / total))
 
 
 def create_phrase_vector(doc,
@@ -131,18 +205,14 @@ def create_phrase_vector(doc,
                          f2,
                          context_function,
                          use_focus,
-                         norm):
+                         norm,
+                         dtype=np.float32):
     """Create a phrase vector by vectorizing the left and right contexts."""
-    if use_focus:
-        phrase = doc[begin:end]
-    else:
-        phrase = []
-    # Create windows.
-    if window > 0:
-        right_window = doc[end:end+window]
-        left_window = doc[max(begin-window, 0):begin][::-1]
-    else:
-        right_window, left_window = [], []
+    left_window, phrase, right_window = _windows(doc,
+                                                 begin,
+                                                 end,
+                                                 window,
+                                                 use_focus)
 
     # Vectorize the context.
     vector = _vectorize_context(phrase,
@@ -152,12 +222,29 @@ def create_phrase_vector(doc,
                                 f1,
                                 f2,
                                 context_function,
-                                norm)
+                                norm,
+                                dtype)
 
     return ("{}-{}-{}".format(left_window[::-1], phrase, right_window),
             vector)
 
 
+def _windows(doc, begin, end, window, use_focus):
+    """Get the left context, phrase and right context of a chunk."""
+    if use_focus:
+        phrase = doc[begin:end]
+    else:
+        phrase = []
+    # Create windows.
+    if window > 0:
+        right_window = doc[end:end+window]
+        left_window = doc[max(begin-window, 0):begin][::-1]
+    else:
+        right_window, left_window = [], []
+
+    return left_window, phrase, right_window
+
+
 def _vectorize_context(phrase,
                        left_window,
                        right_window,
@@ -165,30 +252,32 @@ def _vectorize_context(phrase,
                        f1,
                        f2,
                        context_function,
-                       norm):
+                       norm,
+                       dtype=np.float32):
     """Vectorize the context based on two functions."""
+    # All parts have the same dtype, so combining them never upcasts.
     if phrase:
         phrase_vec = embeddings.vectorize(phrase,
                                           remove_oov=False,
-                                          norm=norm)
+                                          norm=norm).astype(dtype, copy=False)
         phrase_vec = f1(phrase_vec, axis=0)
     else:
-        phrase_vec = np.zeros(embeddings.size)
+        phrase_vec = np.zeros(embeddings.size, dtype=dtype)
     if left_window:
         left_vec = embeddings.vectorize(left_window,
                                         remove_oov=False,
-                                        norm=norm)
+                                        norm=norm).astype(dtype, copy=False)
         left_vec = f1(context_function(left_vec), axis=0)
     else:
-        left_vec = np.zeros(embeddings.size)
+        left_vec = np.zeros(embeddings.size, dtype=dtype)
     if right_window:
         right_vec = embeddings.vectorize(right_window,
                                          remove_oov=False,
-                                         norm=norm)
+                                         norm=norm).astype(dtype, copy=False)
         right_vec = f1(context_function(right_vec), axis=0)
     else:
-        right_vec = np.zeros(embeddings.size)
+        right_vec = np.zeros(embeddings.size, dtype=dtype)
 
     vector = f2([left_vec, phrase_vec, right_vec], axis=0)
 
-    return vector
+    return vector.astype(dtype, copy=False)
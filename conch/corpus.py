@@ -0,0 +1,187 @@
+"""A memory-mapped container of tokenized and chunked documents."""
+import json
+import os
+import numpy as np
+
+from conch.embeddings import _dump_json
+from conch.evaluation.knn import code_dtype
+
+
+def save_corpus(documents, path):
+    """
+    Save documents as a corpus.
+
+    Tokens and BIO tags are stored as integer codes into a vocabulary and
+    a tag table, concatenated over all documents, together with the offset
+    of each document and its key.
+
+    Parameters
+    ==========
+    documents : dict
+        A dictionary mapping from document keys to (tokens, bio) tuples,
+        as produced by the preprocessing. The documents are stored in
+        order of their keys.
+    path : str
+        The directory of the corpus. It is created if it does not exist.
+
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    keys = sorted(documents)
+    vocabulary, tags = {}, {}
+    token_ids, tag_codes = [], []
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+
+    for idx, key in enumerate(keys):
+        txt, bio = documents[key]
+        assert len(txt) == len(bio)
+        token_ids.append([vocabulary.setdefault(x, len(vocabulary))
+                          for x in txt])
+        tag_codes.append([tags.setdefault(x, len(tags)) for x in bio])
+        offsets[idx + 1] = offsets[idx] + len(txt)
+
+    vocabulary = sorted(vocabulary, key=vocabulary.get)
+    tags = sorted(tags, key=tags.get)
+
+    np.save(os.path.join(path, "tokens.npy"),
+            np.fromiter((x for doc in token_ids for x in doc),
+                        dtype=np.int32,
+                        count=offsets[-1]))
+    np.save(os.path.join(path, "tags.npy"),
+            np.fromiter((x for doc in tag_codes for x in doc),
+                        dtype=code_dtype(len(tags)),
+                        count=offsets[-1]))
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    _dump_json(vocabulary, os.path.join(path, "vocabulary.json"))
+    _dump_json(tags, os.path.join(path, "tag_table.json"))
+    # The keys are written last, so an incomplete corpus can not be opened.
+    _dump_json(keys, os.path.join(path, "keys.json"))
+
+
+class Corpus(object):
+    """
+    Memory-mapped corpus of documents, with random access by document.
+
+    A corpus behaves like the sorted list of (tokens, bio) tuples which
+    the experiments used to create from the preprocessed JSON files, so
+    it can be passed to compose directly. Documents are only decoded to
+    strings when they are accessed.
+
+    Parameters
+    ==========
+    path : str
+        The directory of a corpus written by save_corpus.
+
+    Attributes
+    ==========
+    keys : list of str
+        The key of each document.
+    vocabulary : list of str
+        The token of each token id.
+    tags : list of str
+        The BIO tag of each tag code.
+    token_ids : np.array
+        The token ids of all documents, concatenated.
+    tag_codes : np.array
+        The tag codes of all documents, concatenated.
+    offsets : np.array
+        The start of each document in token_ids and tag_codes, followed by
+        the total number of tokens.
+
+    """
+
+    def __init__(self, path):
+        """Open a corpus."""
+        self.path = path
+        self.keys = json.load(open(os.path.join(path, "keys.json")))
+        self.vocabulary = json.load(open(os.path.join(path,
+                                                      "vocabulary.json")))
+        self.tags = json.load(open(os.path.join(path, "tag_table.json")))
+        self.token_ids = np.load(os.path.join(path, "tokens.npy"),
+                                 mmap_mode="r")
+        self.tag_codes = np.load(os.path.join(path, "tags.npy"),
+                                 mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self._index = {k: idx for idx, k in enumerate(self.keys)}
+
+    def __len__(self):
+        """Get the number of documents."""
+        return len(self.keys)
+
+    def __getitem__(self, idx):
+        """Get a document as a (tokens, bio) tuple by position or key."""
+        if isinstance(idx, str):
+            idx = self._index[idx]
+        elif idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("Document {} is out of range".format(idx))
+        return self.tokens(idx), self.bio(idx)
+
+    def __iter__(self):
+        """Iterate over the documents in order."""
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def _slice(self, idx):
+        """Get the slice of a document."""
+        return slice(self.offsets[idx], self.offsets[idx + 1])
+
+    def tokens(self, idx):
+        """Get the tokens of the document at a position."""
+        return [self.vocabulary[x]
+                for x in self.token_ids[self._slice(idx)].tolist()]
+
+    def bio(self, idx):
+        """Get the BIO tags of the document at a position."""
+        return [self.tags[x]
+                for x in self.tag_codes[self._slice(idx)].tolist()]
+
+    def lengths(self):
+        """Get the number of tokens of each document."""
+        return np.diff(self.offsets)
+
+    def all_tokens(self):
+        """Get the tokens of all documents as a single list."""
+        return [self.vocabulary[x] for x in self.token_ids.tolist()]
+
+    def all_bio(self):
+        """Get the BIO tags of all documents as a single list."""
+        return [self.tags[x] for x in self.tag_codes.tolist()]
+
+    def chunks(self):
+        """
+        Find the chunks of all documents.
+
+        A chunk is a B tag followed by any number of I tags within the same
+        document, like in bio_to_index.
+
+        Returns
+        =======
+        documents : np.array
+            The position of the document of each chunk.
+        begin : np.array
+            The begin of each chunk, relative to its document.
+        end : np.array
+            The end of each chunk, relative to its document.
+        tags : np.array
+            The tag code of the first tag of each chunk.
+
+        """
+        # The empty prefix keeps the array of strings valid for empty
+        # corpora, which have no tags.
+        prefixes = np.array([x.split("-")[0] for x in self.tags] + [""])
+        codes = np.asarray(self.tag_codes, dtype=np.int64)
+        is_begin = prefixes[codes] == "B"
+        inside = prefixes[codes] == "I"
+        # An I tag at the start of a document does not continue a chunk.
+        inside[self.offsets[:-1][self.lengths() > 0]] = False
+
+        begin = np.flatnonzero(is_begin)
+        breaks = np.append(np.flatnonzero(~inside), len(codes))
+        end = breaks[np.searchsorted(breaks, begin, "right")]
+        documents = np.searchsorted(self.offsets, begin, "right") - 1
+        offsets = self.offsets[documents]
+
+        return documents, begin - offsets, end - offsets, codes[begin]
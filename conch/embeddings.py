@@ -0,0 +1,348 @@
+"""Load word embeddings through a memory-mapped binary cache."""
+import json
+import os
+import numpy as np
+
+from reach import Reach
+
+
+def load_embeddings(pathtovector,
+                    unk_word=None,
+                    cache_dir=None,
+                    header=True):
+    """
+    Load word vectors in .vec format through a binary cache.
+
+    The first time a vector file is loaded, it is converted to float32
+    .npy files and a vocabulary file. Later loads memory-map these files,
+    which is near-instant, and lets many processes share the same pages.
+    The cache is rebuilt whenever the vector file changes.
+
+    Parameters
+    ==========
+    pathtovector : str
+        The path to the vector file.
+    unk_word : str, optional, default None
+        The item which is used for out of vocabulary words.
+    cache_dir : str, optional, default None
+        The directory in which the cache is stored. If this is None, the
+        cache is stored next to the vector file.
+    header : bool, optional, default True
+        Whether the vector file has a header of the type
+        (NUMBER OF ITEMS, SIZE OF VECTOR).
+
+    Returns
+    =======
+    embeddings : Reach
+        A reach instance whose vectors are memory-mapped.
+
+    """
+    prefix = cache_prefix(pathtovector, cache_dir)
+    if not _is_valid(pathtovector, prefix):
+        convert(pathtovector, prefix, header)
+
+    return load_cache(prefix,
+                      unk_word,
+                      name=os.path.split(pathtovector)[-1])
+
+
+def corpus_vocabulary(documents, concepts=None):
+    """
+    Collect the tokens which are looked up when composing a corpus.
+
+    Tokens are lowercased, like they are in compose and create_concepts.
+
+    Parameters
+    ==========
+    documents : list of tuples or Corpus
+        The documents, as (tokens, bio) tuples, or a corpus, of which only
+        the vocabulary is read.
+    concepts : dict, optional, default None
+        A dictionary mapping from concept names to lists of descriptions.
+
+    Returns
+    =======
+    vocabulary : set
+        The set of tokens.
+
+    """
+    from conch.corpus import Corpus
+
+    vocabulary = set()
+    if isinstance(documents, Corpus):
+        documents = [(documents.vocabulary, None)]
+    for txt, _ in documents:
+        vocabulary.update(" ".join(txt).lower().split())
+    if concepts is not None:
+        for descriptions in concepts.values():
+            for desc in descriptions:
+                vocabulary.update(desc.lower().split())
+
+    return vocabulary
+
+
+def load_pruned(pathtovector,
+                vocabulary,
+                unk_word=None,
+                cache_dir=None,
+                header=True):
+    """
+    Load only the word vectors of a vocabulary.
+
+    If a valid binary cache of the vector file exists, the rows are taken
+    from the cache. Otherwise the vector file is streamed, and only the
+    rows of the vocabulary are parsed.
+
+    Parameters
+    ==========
+    pathtovector : str
+        The path to the vector file.
+    vocabulary : set
+        The words to keep, e.g. the output of corpus_vocabulary.
+    unk_word : str, optional, default None
+        The item which is used for out of vocabulary words. It is always
+        kept.
+    cache_dir : str, optional, default None
+        The directory in which the cache is stored.
+    header : bool, optional, default True
+        Whether the vector file has a header.
+
+    Returns
+    =======
+    embeddings : Reach
+        A reach instance containing only the vectors of the vocabulary.
+
+    """
+    vocabulary = set(vocabulary)
+    if unk_word is not None:
+        vocabulary.add(unk_word)
+
+    prefix = cache_prefix(pathtovector, cache_dir)
+    if _is_valid(pathtovector, prefix):
+        cached = load_cache(prefix)
+        words = [w for w in cached.items if w in vocabulary]
+        vectors = cached.vectors[[cached.items[w] for w in words]]
+        total = len(cached.items)
+    else:
+        words, vectors = [], []
+        total = 0
+        with open(pathtovector, encoding="utf-8") as f:
+            if header:
+                next(f)
+            for line in f:
+                if not line.strip():
+                    continue
+                total += 1
+                word, rest = line.rstrip(" \n").split(" ", 1)
+                if word not in vocabulary:
+                    continue
+                words.append(word)
+                vectors.append(np.fromstring(rest,
+                                             sep=" ",
+                                             dtype=np.float32))
+
+    print("Kept {} out of {} rows".format(len(words), total))
+
+    r = Reach(np.array(vectors, dtype=np.float32).reshape(len(words), -1),
+              words,
+              name=os.path.split(pathtovector)[-1])
+    if unk_word is not None:
+        try:
+            r.unk_index = r.items[unk_word]
+        except KeyError:
+            raise ValueError("'{}' is not present in the vector "
+                             "space.".format(unk_word))
+
+    return r
+
+
+def cache_prefix(pathtovector, cache_dir=None):
+    """Get the prefix of the cache files of a vector file."""
+    if cache_dir is None:
+        return pathtovector
+    return os.path.join(cache_dir, os.path.split(pathtovector)[-1])
+
+
+def _fingerprint(pathtovector):
+    """Identify the state of a file by its size and modification time."""
+    stat = os.stat(pathtovector)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def _is_valid(pathtovector, prefix):
+    """Check whether the cache exists, and belongs to the vector file."""
+    try:
+        meta = json.load(open("{}_meta.json".format(prefix)))
+    except (IOError, ValueError):
+        return False
+
+    return meta == _fingerprint(pathtovector)
+
+
+def convert(pathtovector, prefix, header=True, dtype=np.float32):
+    """
+    Convert a vector file to the binary cache format.
+
+    The cache consists of {prefix}_vectors.npy, {prefix}_norm.npy and
+    {prefix}_words.json, and {prefix}_meta.json, which identifies the
+    vector file the cache was made from. The meta file is written last,
+    so an interrupted conversion is never seen as a valid cache.
+
+    Parameters
+    ==========
+    pathtovector : str
+        The path to the vector file.
+    prefix : str
+        The prefix of the cache files.
+    header : bool, optional, default True
+        Whether the vector file has a header.
+    dtype : numpy dtype, optional, default np.float32
+        The dtype of the cached vectors.
+
+    """
+    fingerprint = _fingerprint(pathtovector)
+
+    with open(pathtovector, encoding="utf-8") as f:
+        if header:
+            num, size = [int(x) for x in f.readline().split()]
+        else:
+            size = len(f.readline().split()) - 1
+            num = 1 + sum(1 for line in f if line.strip())
+
+    words = []
+    addedwords = set()
+    # Several processes may convert the same file at the same time, so
+    # each writes to its own temporary files.
+    tmp = "{}_vectors.{}.tmp.npy".format(prefix, os.getpid())
+    vectors = np.lib.format.open_memmap(tmp,
+                                        mode="w+",
+                                        dtype=dtype,
+                                        shape=(num, size))
+
+    with open(pathtovector, encoding="utf-8") as f:
+        if header:
+            next(f)
+        for idx, line in enumerate(f):
+            if not line.strip():
+                continue
+            word, rest = line.rstrip(" \n").split(" ", 1)
+            if word in addedwords:
+                raise ValueError("Duplicate: {} was in the "
+                                 "vector space twice".format(word))
+            vec = np.fromstring(rest, sep=" ", dtype=dtype)
+            if len(vec) != size:
+                raise ValueError("Incorrect input at index {}, size "
+                                 "is {}, expected "
+                                 "{}".format(idx, len(vec), size))
+            vectors[len(words)] = vec
+            words.append(word)
+            addedwords.add(word)
+
+    if len(words) != num:
+        raise ValueError("The header says there are {} items, but "
+                         "found {}".format(num, len(words)))
+
+    norm_tmp = "{}_norm.{}.tmp.npy".format(prefix, os.getpid())
+    norm_vectors = np.lib.format.open_memmap(norm_tmp,
+                                             mode="w+",
+                                             dtype=dtype,
+                                             shape=(num, size))
+    for i in range(0, num, 100000):
+        norm_vectors[i:i+100000] = Reach.normalize(vectors[i:i+100000])
+
+    vectors.flush()
+    norm_vectors.flush()
+    del vectors, norm_vectors
+
+    os.replace(tmp, "{}_vectors.npy".format(prefix))
+    os.replace(norm_tmp, "{}_norm.npy".format(prefix))
+    _dump_json(words, "{}_words.json".format(prefix))
+    _dump_json(fingerprint, "{}_meta.json".format(prefix))
+
+
+def _dump_json(obj, path):
+    """Write a JSON file, and move it into place when done."""
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+
+def load_cache(prefix, unk_word=None, name=""):
+    """
+    Load a binary cache as a Reach instance with memory-mapped vectors.
+
+    Parameters
+    ==========
+    prefix : str
+        The prefix of the cache files.
+    unk_word : str, optional, default None
+        The item which is used for out of vocabulary words.
+    name : str, optional, default ""
+        The name of the Reach instance.
+
+    Returns
+    =======
+    embeddings : Reach
+        A reach instance whose vectors are memory-mapped.
+
+    """
+    words = json.load(open("{}_words.json".format(prefix)))
+    vectors = np.load("{}_vectors.npy".format(prefix), mmap_mode="r")
+    norm_vectors = np.load("{}_norm.npy".format(prefix), mmap_mode="r")
+
+    return reach_from_arrays(vectors, norm_vectors, words, unk_word, name)
+
+
+def reach_from_arrays(vectors,
+                      norm_vectors,
+                      words,
+                      unk_word=None,
+                      name=""):
+    """
+    Create a Reach instance from precomputed arrays.
+
+    Unlike the Reach constructor, this does not copy or normalize the
+    vectors, so memory-mapped arrays stay memory-mapped.
+
+    Parameters
+    ==========
+    vectors : np.array
+        The vectors.
+    norm_vectors : np.array
+        The vectors, normalized to unit length.
+    words : list
+        The item for each vector.
+    unk_word : str, optional, default None
+        The item which is used for out of vocabulary words.
+    name : str, optional, default ""
+        The name of the Reach instance.
+
+    Returns
+    =======
+    embeddings : Reach
+        A reach instance using the arrays.
+
+    """
+    if len(words) != len(vectors) or len(vectors) != len(norm_vectors):
+        raise ValueError("Your vector space and list of items are not "
+                         "the same length: "
+                         "{} != {}".format(len(vectors), len(words)))
+
+    r = Reach.__new__(Reach)
+    r.items = {w: idx for idx, w in enumerate(words)}
+    r.indices = {v: k for k, v in r.items.items()}
+    r.vectors = vectors
+    r.norm_vectors = norm_vectors
+    r.size = vectors.shape[1]
+    r.name = name
+    r.unk_index = None
+
+    if unk_word is not None:
+        try:
+            r.unk_index = r.items[unk_word]
+        except KeyError:
+            raise ValueError("'{}' is not present in the vector "
+                             "space.".format(unk_word))
+
+    return r
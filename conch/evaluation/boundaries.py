@@ -0,0 +1,219 @@
+"""Analysis of the chunk boundaries of a chunker with regard to gold chunks."""
+import numpy as np
+
+from conch.corpus import Corpus
+from .utils import align_chunks, overlaps
+
+# The boundary categories, in the order of their codes.
+CATEGORIES = ("exact",
+              "too_long",
+              "too_short",
+              "shifted",
+              "split",
+              "merged",
+              "missed",
+              "spurious")
+EXACT, TOO_LONG, TOO_SHORT, SHIFTED, SPLIT, MERGED, MISSED, SPURIOUS = range(8)
+
+
+def boundary_errors(gold_bio, pred_bio):
+    """
+    Assign a boundary category to every gold and predicted chunk.
+
+    Labels are ignored, only the boundaries of the chunks are compared.
+    A gold chunk without overlapping predicted chunks is missed, and a
+    predicted chunk without overlapping gold chunks is spurious. A gold
+    chunk which overlaps with several predicted chunks is split, and a
+    predicted chunk which overlaps with several gold chunks is merged.
+    Chunks which overlap with these are given the same category. All
+    other chunks form one to one pairs, which are exact, too long or too
+    short if the predicted chunk contains or is contained by the gold
+    chunk, and shifted otherwise.
+
+    Parameters
+    ==========
+    gold_bio : list of lists of strings or Corpus
+        The BIO strings of the gold standard data.
+    pred_bio : list of lists of strings or Corpus
+        The BIO strings of the predicted data.
+
+    Returns
+    =======
+    gold : np.array
+        An array of shape (chunks, 2) of the gold spans, on the axis of
+        align_chunks.
+    gold_categories : np.array
+        The category code of each gold chunk, see CATEGORIES.
+    pred : np.array
+        An array of shape (chunks, 2) of the predicted spans.
+    pred_categories : np.array
+        The category code of each predicted chunk.
+    shift : np.array
+        The position of the start of each document on the axis.
+
+    """
+    gold, _, pred, shift = align_chunks(gold_bio, pred_bio)
+
+    num_pred, first_pred = overlaps(gold, pred)
+    num_gold, first_gold = overlaps(pred, gold)
+
+    gold_categories = np.full(len(gold), MISSED, dtype=np.uint8)
+    pred_categories = np.full(len(pred), SPURIOUS, dtype=np.uint8)
+
+    gold_categories[num_pred > 1] = SPLIT
+    pred_categories[num_gold > 1] = MERGED
+
+    # Predicted chunks within a split gold chunk, and gold chunks within a
+    # merged predicted chunk.
+    single = np.flatnonzero(num_gold == 1)
+    split = num_pred[first_gold[single]] > 1
+    pred_categories[single[split]] = SPLIT
+    single = np.flatnonzero(num_pred == 1)
+    merged = num_gold[first_pred[single]] > 1
+    gold_categories[single[merged]] = MERGED
+
+    # The remaining chunks are one to one pairs.
+    gold_idx = single[~merged]
+    pred_idx = first_pred[gold_idx]
+    g, p = gold[gold_idx], pred[pred_idx]
+
+    contains = (p[:, 0] <= g[:, 0]) & (p[:, 1] >= g[:, 1])
+    contained = (p[:, 0] >= g[:, 0]) & (p[:, 1] <= g[:, 1])
+    categories = np.full(len(g), SHIFTED, dtype=np.uint8)
+    categories[contains] = TOO_LONG
+    categories[contained] = TOO_SHORT
+    categories[contains & contained] = EXACT
+
+    gold_categories[gold_idx] = categories
+    pred_categories[pred_idx] = categories
+
+    return gold, gold_categories, pred, pred_categories, shift
+
+
+def analyse_boundaries(gold_bio, pred_bio, tokens=None, top=20):
+    """
+    Summarize the boundary errors of a chunker over a whole corpus.
+
+    Parameters
+    ==========
+    gold_bio : list of lists of strings or Corpus
+        The BIO strings of the gold standard data.
+    pred_bio : list of lists of strings or Corpus
+        The BIO strings of the predicted data.
+    tokens : list of lists of strings, optional, default None
+        The tokens of each document. If this is None, and gold_bio is a
+        corpus, its tokens are used. Otherwise no tokens are counted.
+    top : int, optional, default 20
+        The number of most frequent offending tokens to return.
+
+    Returns
+    =======
+    summary : dict
+        A dictionary with the following keys:
+            "gold" and "pred": the number of gold and predicted chunks in
+            each category.
+            "length_differences": the number of one to one pairs for each
+            difference between the length of the predicted and the gold
+            chunk.
+            "extra_tokens": the most frequent tokens which are in a
+            predicted chunk, but not in its gold chunk, with their counts.
+            "missing_tokens": the most frequent tokens which are in a gold
+            chunk, but not in its predicted chunk, with their counts.
+
+    """
+    gold, gold_categories, pred, pred_categories, shift = boundary_errors(
+        gold_bio,
+        pred_bio)
+
+    gold_counts = np.bincount(gold_categories, minlength=len(CATEGORIES))
+    pred_counts = np.bincount(pred_categories, minlength=len(CATEGORIES))
+
+    # One to one pairs have the same category on both sides, and are in
+    # the same order on both sides.
+    pairs = np.isin(gold_categories, (EXACT, TOO_LONG, TOO_SHORT, SHIFTED))
+    pred_pairs = np.isin(pred_categories,
+                         (EXACT, TOO_LONG, TOO_SHORT, SHIFTED))
+    differences = (np.diff(pred[pred_pairs], axis=1) -
+                   np.diff(gold[pairs], axis=1)).ravel()
+    values, counts = np.unique(differences, return_counts=True)
+
+    summary = {"gold": dict(zip(CATEGORIES, gold_counts.tolist())),
+               "pred": dict(zip(CATEGORIES, pred_counts.tolist())),
+               "length_differences": dict(zip(values.tolist(),
+                                              counts.tolist())),
+               "extra_tokens": [],
+               "missing_tokens": []}
+
+    if tokens is None and isinstance(gold_bio, Corpus):
+        tokens = gold_bio
+    if tokens is None:
+        return summary
+
+    positions, token_ids, vocabulary = _token_axis(tokens, shift)
+    size = max([0] + [x.max() + 1 for x in (gold, pred, positions)
+                      if x.size])
+    # Positions outside of any document get -1.
+    ids = np.full(size, -1, dtype=np.int64)
+    ids[positions] = token_ids
+
+    # Tokens in the predicted chunk of a pair, but outside its gold chunk,
+    # and the other way around. Within a pair, the predicted chunk
+    # overlaps with no other gold chunk, so coverage by any chunk works.
+    mismatch = pairs.copy()
+    mismatch[pairs] = gold_categories[pairs] != EXACT
+    pred_mismatch = pred_pairs.copy()
+    pred_mismatch[pred_pairs] = pred_categories[pred_pairs] != EXACT
+
+    in_gold = _coverage(gold, size)
+    in_pred = _coverage(pred, size)
+    extra = _coverage(pred[pred_mismatch], size) & ~in_gold
+    missing = _coverage(gold[mismatch], size) & ~in_pred
+
+    summary["extra_tokens"] = _most_common(ids[extra], vocabulary, top)
+    summary["missing_tokens"] = _most_common(ids[missing], vocabulary, top)
+
+    return summary
+
+
+def _token_axis(tokens, shift):
+    """
+    Put the tokens of all documents on the axis of align_chunks.
+
+    Returns the position of each token, its id and the vocabulary.
+    """
+    if isinstance(tokens, Corpus):
+        lengths = tokens.lengths()[:len(shift)]
+        ids = np.asarray(tokens.token_ids[:lengths.sum()], dtype=np.int64)
+        vocabulary = tokens.vocabulary
+    else:
+        tokens = tokens[:len(shift)]
+        lengths = np.array([len(x) for x in tokens], dtype=np.int64)
+        codes = {}
+        ids = np.array([codes.setdefault(x, len(codes))
+                        for doc in tokens for x in doc], dtype=np.int64)
+        vocabulary = sorted(codes, key=codes.get)
+
+    starts = np.cumsum(lengths) - lengths
+    positions = (np.repeat(shift[:len(lengths)] - starts, lengths) +
+                 np.arange(len(ids)))
+
+    return positions, ids, vocabulary
+
+
+def _coverage(spans, size):
+    """Get a mask of all positions which are in any of the spans."""
+    counts = np.zeros(size + 1, dtype=np.int64)
+    np.add.at(counts, spans[:, 0], 1)
+    np.add.at(counts, spans[:, 1], -1)
+
+    return np.cumsum(counts[:-1]) > 0
+
+
+def _most_common(ids, vocabulary, top):
+    """Count token ids, and return the most frequent tokens."""
+    ids = ids[ids >= 0]
+    counts = np.bincount(ids, minlength=len(vocabulary))
+    # Stable, so tokens with the same count are in order of their id.
+    order = np.argsort(-counts, kind="mergesort")[:top]
+
+    return [(vocabulary[x], int(counts[x])) for x in order if counts[x]]
@@ -0,0 +1,115 @@
+"""Checkpoints of batched loops, so long runs can be resumed."""
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+from conch.embeddings import _dump_json
+
+
+class Checkpoint(object):
+    """
+    Progress of a batched loop, which can be resumed after a crash.
+
+    The results are written to a memory-mapped array, and the number of
+    finished items to a JSON file. The array is flushed before the
+    progress is written, so the progress never covers results which are
+    not on disk. Batches must finish in order, like in map_batches.
+
+    Parameters
+    ==========
+    path : str
+        The directory of the checkpoint. It is created if it does not
+        exist.
+    name : str
+        The name of the checkpoint files within the directory.
+    shape : tuple
+        The shape of the results. The first axis is the item axis.
+    dtype : numpy dtype
+        The dtype of the results.
+    settings : dict
+        Anything else which identifies the run, e.g. a label table. A
+        checkpoint can only be resumed with the same shape, dtype and
+        settings.
+    interval : float, optional, default 60
+        The minimum number of seconds between two saves. The progress is
+        always saved when the loop is done.
+
+    Attributes
+    ==========
+    out : np.array
+        The memory-mapped results.
+    done : int
+        The number of items whose results are in out.
+
+    """
+
+    def __init__(self, path, name, shape, dtype, settings, interval=60):
+        """Open a checkpoint, or create it if it does not exist."""
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.interval = interval
+        self._array_path = os.path.join(path, "{}.npy".format(name))
+        self._progress_path = os.path.join(path, "{}.json".format(name))
+
+        settings = dict(settings,
+                        shape=list(shape),
+                        dtype=np.dtype(dtype).str)
+        # Compare settings as they are stored, e.g. tuples become lists.
+        self.settings = json.loads(json.dumps(settings))
+
+        try:
+            progress = json.load(open(self._progress_path))
+        except (IOError, ValueError):
+            progress = None
+
+        if progress is not None:
+            if progress["settings"] != self.settings:
+                raise ValueError("The checkpoint at {} was created with "
+                                 "different settings: "
+                                 "{}".format(self._progress_path,
+                                             progress["settings"]))
+            self.out = np.load(self._array_path, mmap_mode="r+")
+            self.done = progress["done"]
+        else:
+            self.out = np.lib.format.open_memmap(self._array_path,
+                                                 mode="w+",
+                                                 dtype=dtype,
+                                                 shape=tuple(shape))
+            self.done = 0
+
+        self._last = time.time()
+
+    def update(self, end):
+        """Mark all items before end as done, and save if it is time."""
+        self.done = end
+        if time.time() - self._last >= self.interval:
+            self.save()
+
+    def save(self):
+        """Write the results and the progress to disk."""
+        self.out.flush()
+        _dump_json({"settings": self.settings, "done": self.done},
+                   self._progress_path)
+        self._last = time.time()
+
+
+def digest(array, block_size=1 << 26):
+    """
+    Hash the contents of an array, to identify it in the settings.
+
+    The array is hashed in blocks of rows of about block_size bytes, so a
+    memory-mapped array is never copied into memory as a whole.
+
+    """
+    array = np.asanyarray(array)
+    h = hashlib.sha1()
+    if array.ndim == 0:
+        h.update(np.ascontiguousarray(array))
+    else:
+        row_size = max(array[:1].nbytes, 1)
+        step = max(block_size // row_size, 1)
+        for begin in range(0, len(array), step):
+            h.update(np.ascontiguousarray(array[begin:begin+step]))
+    return "{}-{}".format(array.dtype.str, h.hexdigest())
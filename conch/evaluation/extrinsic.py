@@ -1,11 +1,33 @@
 """Evaluation against a set of concept labels."""
 import numpy as np
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from tqdm import tqdm
-from .utils import bio_to_index
+from reach import Reach
 
+from conch.conch import iter_phrases
+from conch.corpus import Corpus
+from conch.label_table import LabelTable
+from .checkpoint import Checkpoint, digest
+from .knn import code_dtype
+from .utils import (bio_to_index,
+                    unique_rows,
+                    map_batches,
+                    num_batches,
+                    report_skipped)
 
-def eval_extrinsic_label(vectors, concepts, labels, batch_size):
+
+def eval_extrinsic_label(vectors,
+                         concepts,
+                         labels,
+                         batch_size,
+                         deduplicate=False,
+                         n_jobs=1,
+                         checkpoint=None,
+                         checkpoint_interval=60,
+                         mask=None):
     """
     Evaluate the set of composed vectors against a set of concept vectors.
 
@@ -15,11 +37,28 @@ def eval_extrinsic_label(vectors, concepts, labels, batch_size):
         A reach instance which contains the composed vectors.
     concepts : Reach
         A reach instance which contains the composed concept vectors.
-    labels : list of string
-        A list of labels for each concept, which are used to assign labels.
-        Must be equal to the number of concepts.
+    labels : dict or LabelTable
+        A mapping from concept names to labels, which are used to assign
+        labels. Every concept must have a label.
     batch_size : int
         The batch size to use during processing.
+    deduplicate : bool, optional, default False
+        Whether to remove identical vectors before searching. Each unique
+        vector is only searched once, and its label is copied to all
+        chunks with the same vector.
+    n_jobs : int, optional, default 1
+        The number of threads over which the batches are divided.
+    checkpoint : str, optional, default None
+        If this is not None, the labels are written to a checkpoint in this
+        directory as batches finish. A run which is interrupted resumes
+        from the last checkpoint when it is started again.
+    checkpoint_interval : float, optional, default 60
+        The minimum number of seconds between two checkpoints.
+    mask : np.array, optional, default None
+        A boolean mask of the vectors which are not zero, e.g. from
+        compose with return_mask. Zero vectors, e.g. of phrases which
+        only contain OOV words, get the label "np" without being searched.
+        If this is None, the mask is computed from the vectors.
 
     Returns
     =======
@@ -27,32 +66,104 @@ def eval_extrinsic_label(vectors, concepts, labels, batch_size):
         A label for each chunk.
 
     """
-    results = []
-    nones = 0
+    norm_vectors = vectors.norm_vectors
+
+    if mask is None:
+        mask = norm_vectors.any(1)
+    mask = np.asarray(mask, dtype=bool)
+
+    if deduplicate:
+        index, inverse = unique_rows(norm_vectors)
+        print("Unique queries: {} out of {}, hit rate {:.3f}".format(
+              len(index),
+              len(norm_vectors),
+              1 - len(index) / max(len(norm_vectors), 1)))
+        norm_vectors = norm_vectors[index]
+        mask = mask[index]
+
+    # Only the rows of nonzero vectors are searched.
+    rows = np.flatnonzero(mask)
+    report_skipped(len(mask) - len(rows), len(mask))
+
+    # Labels are stored as codes into a table, so they fit in an array.
+    if isinstance(labels, LabelTable):
+        values = labels.labels
+    elif isinstance(labels, dict):
+        values = labels.values()
+    else:
+        values = labels
+    table = sorted(set(values) | {"np"})
+    codes = {label: idx for idx, label in enumerate(table)}
+    dtype = code_dtype(len(table))
+    num = len(norm_vectors)
+
+    if checkpoint is None:
+        out, start = np.empty(num, dtype=dtype), 0
+    else:
+        state = Checkpoint(checkpoint,
+                           "labels",
+                           (num,),
+                           dtype,
+                           {"table": table,
+                            "vectors": digest(norm_vectors),
+                            "mask": digest(mask)},
+                           checkpoint_interval)
+        out, start = state.out, state.done
+
+    out[~mask] = codes["np"]
+    label_batch = partial(_label_batch,
+                          vectors=norm_vectors,
+                          concepts=concepts,
+                          labels=labels,
+                          rows=rows)
+    batches = map_batches(label_batch, len(rows), batch_size, n_jobs, start)
 
-    for batch in tqdm(range(0, len(vectors.norm_vectors), batch_size)):
+    begin = start
+    for batch in tqdm(batches, total=num_batches(len(rows) - start,
+                                                 batch_size)):
+        end = begin + len(batch)
+        out[rows[begin:end]] = [codes[x] for x in batch]
+        begin = end
+        if checkpoint is not None:
+            state.update(end)
 
-        batch = vectors.norm_vectors[batch:batch+batch_size]
+    if checkpoint is not None:
+        state.save()
 
-        # Compute the distances from the current batch to all other vectors.
-        res = concepts.nearest_neighbor(batch, num=1)
-        for result, vec in zip(res, batch):
-            if not np.any(vec):
-                results.append("np")
-                nones += 1
-                continue
+    results = [table[x] for x in out.tolist()]
 
-            results.append(labels[result[0][0]])
+    if deduplicate:
+        results = [results[x] for x in inverse]
 
     assert(len(results) == len(vectors.norm_vectors))
     return results
 
 
+def _label_batch(begin, end, vectors, concepts, labels, rows=None):
+    """Label a single batch of nonzero vectors, or of rows of vectors."""
+    if rows is None:
+        batch = vectors[begin:end]
+    else:
+        batch = vectors[rows[begin:end]]
+    # Search in the dtype of the concepts, see _code_batch.
+    batch = batch.astype(concepts.norm_vectors.dtype, copy=False)
+
+    # Compute the distances from the current batch to all other vectors.
+    res = concepts.nearest_neighbor(batch, num=1)
+
+    return [labels[result[0][0]] for result in res]
+
+
 def eval_extrinsic(chunk_bio,
                    vectors,
                    concepts,
                    concept_labels,
-                   batch_size):
+                   batch_size,
+                   deduplicate=False,
+                   n_jobs=1,
+                   checkpoint=None,
+                   checkpoint_interval=60,
+                   mask=None):
     """
     Produce a BIO sequence of labels given a BIO sequence of Phrase chunks.
 
@@ -62,17 +173,29 @@ def eval_extrinsic(chunk_bio,
 
     Parameters
     ==========
-    chunk_bio : list of strings
-        A list of BIO tags.
+    chunk_bio : list of strings, list of lists of strings or Corpus
+        A list of BIO tags, or the BIO tags of each document, or a corpus.
+        The chunks of documents are found per document, and the documents
+        are concatenated in the result.
     vectors : Reach
         A reach instance which contains the composed chunk vectors.
     concepts : Reach
         A reach instance which contains the composed concept vectors.
-    labels : list of string
-        A list of labels for each concept, which are used to assign labels.
-        Must be equal to the number of concepts.
+    labels : dict or LabelTable
+        A mapping from concept names to labels, which are used to assign
+        labels. Every concept must have a label.
     batch_size : int
         The batch size to use during processing.
+    deduplicate : bool, optional, default False
+        Whether to search identical chunk vectors only once.
+    n_jobs : int, optional, default 1
+        The number of threads over which the batches are divided.
+    checkpoint : str, optional, default None
+        A directory for checkpoints, see eval_extrinsic_label.
+    checkpoint_interval : float, optional, default 60
+        The minimum number of seconds between two checkpoints.
+    mask : np.array, optional, default None
+        A boolean mask of the nonzero vectors, see eval_extrinsic_label.
 
     Returns
     =======
@@ -80,19 +203,175 @@ def eval_extrinsic(chunk_bio,
         A list of BIO tags, with the length of the original BIO sequence.
 
     """
-    new_bio = ["O"] * len(chunk_bio)
+    if isinstance(chunk_bio, Corpus):
+        documents, begin, end, _ = chunk_bio.chunks()
+        offsets = chunk_bio.offsets[documents]
+        chunk_indices = list(zip((begin + offsets).tolist(),
+                                 (end + offsets).tolist(),
+                                 documents.tolist()))
+        new_bio = ["O"] * int(chunk_bio.offsets[-1])
+    elif chunk_bio and not isinstance(chunk_bio[0], str):
+        # Chunks are found per document, so they never cross documents.
+        chunk_indices, offset = [], 0
+        for bio, chunks in zip(chunk_bio, bio_to_index(chunk_bio)):
+            chunk_indices.extend((begin + offset, end + offset, label)
+                                 for begin, end, label in chunks)
+            offset += len(bio)
+        new_bio = ["O"] * offset
+    else:
+        # bio_to_index produces a dict, and expects multiple sequences
+        # so we pass a list, and take the first element of the dict.
+        chunk_indices = bio_to_index([chunk_bio])[0]
+        new_bio = ["O"] * len(chunk_bio)
+
     results = eval_extrinsic_label(vectors,
                                    concepts,
                                    concept_labels,
-                                   batch_size)
-
-    # bio_to_index produces a dict, and expects multiple sequences
-    # so we pass a list, and take the first element of the dict.
-    chunk_indices = bio_to_index([chunk_bio])[0]
+                                   batch_size,
+                                   deduplicate,
+                                   n_jobs,
+                                   checkpoint,
+                                   checkpoint_interval,
+                                   mask)
 
     assert len(results) == len(chunk_indices)
 
-    for (begin, end, _), label in zip(chunk_indices, results):
+    _insert_labels(new_bio, [x[:2] for x in chunk_indices], results)
+
+    return new_bio
+
+
+def eval_extrinsic_pipelined(documents,
+                             embeddings,
+                             concepts,
+                             concept_labels,
+                             batch_size,
+                             window,
+                             context_function,
+                             use_focus=True,
+                             norm=False,
+                             dtype=np.float32,
+                             n_jobs=1,
+                             queue_size=None):
+    """
+    Compose and label the phrases of documents in overlapping stages.
+
+    The phrases are composed in the calling thread, and each batch of
+    batch_size phrases is labelled in a thread pool as soon as it is
+    complete, while the next batch is composed. The batches are the same
+    as those of eval_extrinsic_label, which also leaves out zero vectors,
+    so the result is identical to calling compose and then eval_extrinsic
+    on a corpus, but the phrases of the whole corpus are never in memory
+    at the same time.
+
+    Parameters
+    ==========
+    documents : list of tuples or Corpus
+        The (tokens, bio) tuples of the documents, see compose.
+    embeddings : Reach
+        The word embeddings.
+    concepts : Reach
+        A reach instance which contains the composed concept vectors.
+    concept_labels : dict or LabelTable
+        A mapping from concept names to labels.
+    batch_size : int
+        The batch size to use during labelling.
+    window : int
+        The window size to use.
+    context_function : function
+        The function which is used to weigh the contexts.
+    use_focus : bool, optional, default True
+        Whether to vectorize the focus word.
+    norm : bool, optional, default False
+        Whether to use the unit vectors to compose.
+    dtype : numpy dtype, optional, default np.float32
+        The dtype in which the phrases are composed.
+    n_jobs : int, optional, default 1
+        The number of threads which label batches.
+    queue_size : int, optional, default None
+        The maximum number of composed batches which are waiting for or
+        being labelled. Composition pauses while this many batches are
+        queued. If this is None, it is 2 * n_jobs.
+
+    Returns
+    =======
+    new_bio : list of string
+        A list of BIO tags for all documents, concatenated.
+
+    """
+    if isinstance(documents, Corpus):
+        offsets = documents.offsets.tolist()
+    else:
+        offsets = np.cumsum([0] + [len(bio) for _, bio in documents])
+        offsets = offsets.tolist()
+    if queue_size is None:
+        queue_size = 2 * n_jobs
+
+    new_bio = ["O"] * int(offsets[-1])
+    phrases = iter_phrases(documents,
+                           embeddings,
+                           window,
+                           context_function,
+                           use_focus,
+                           norm,
+                           dtype=dtype)
+    label_phrases = partial(_label_phrases,
+                            concepts=concepts,
+                            labels=concept_labels)
+
+    # Counts the zero vectors and all phrases.
+    counts = [0, 0]
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = deque()
+        for spans, vectors in _phrase_batches(phrases,
+                                              offsets,
+                                              batch_size,
+                                              dtype,
+                                              counts):
+            futures.append(executor.submit(label_phrases, spans, vectors))
+            if len(futures) >= queue_size:
+                _insert_labels(new_bio, *futures.popleft().result())
+        while futures:
+            _insert_labels(new_bio, *futures.popleft().result())
+
+    report_skipped(*counts)
+
+    return new_bio
+
+
+def _phrase_batches(phrases, offsets, batch_size, dtype, counts):
+    """
+    Group composed phrases into batches of spans and vectors.
+
+    Zero vectors are left out, because they get the label "np", which is
+    not inserted in the BIO sequence anyway.
+    """
+    spans, vectors = [], []
+    for idx, begin, end, _, vector in phrases:
+        counts[1] += 1
+        if not vector.any():
+            counts[0] += 1
+            continue
+        spans.append((begin + offsets[idx], end + offsets[idx]))
+        vectors.append(vector)
+        if len(spans) == batch_size:
+            yield spans, np.array(vectors, dtype=dtype)
+            spans, vectors = [], []
+    if spans:
+        yield spans, np.array(vectors, dtype=dtype)
+
+
+def _label_phrases(spans, vectors, concepts, labels):
+    """Label a batch of composed phrases, like eval_extrinsic_label."""
+    # Normalized per row, like the norm_vectors of the composed Reach.
+    norm_vectors = Reach.normalize(vectors)
+    return spans, _label_batch(0, len(spans), norm_vectors, concepts, labels)
+
+
+def _insert_labels(new_bio, spans, labels):
+    """Insert labelled chunks in a BIO sequence."""
+    for (begin, end), label in zip(spans, labels):
         if label == "np":
             continue
         for idx in range(0, end-begin):
@@ -100,5 +379,3 @@ def eval_extrinsic(chunk_bio,
                 new_bio[begin] = "B-{}".format(label)
             else:
                 new_bio[begin + idx] = "I-{}".format(label)
-
-    return new_bio
@@ -2,9 +2,17 @@
 import numpy as np
 
 from collections import Counter
-from reach import Reach
+from functools import partial
 from tqdm import tqdm
-from .utils import bio_to_index
+from conch.corpus import Corpus
+from conch.embeddings import reach_from_arrays
+from .checkpoint import Checkpoint, digest
+from .knn import self_knn, code_dtype
+from .utils import (align_chunks,
+                    overlaps,
+                    map_batches,
+                    num_batches,
+                    report_skipped)
 
 
 def evaluate_transfer(gold_bio,
@@ -14,7 +22,11 @@ def evaluate_transfer(gold_bio,
                       train_embeddings,
                       test_embeddings,
                       k=10,
-                      batch_size=250):
+                      batch_size=250,
+                      n_jobs=1,
+                      encoded=False,
+                      checkpoint=None,
+                      checkpoint_interval=60):
     """
     Do a transfer experiment between corpora.
 
@@ -46,37 +58,68 @@ def evaluate_transfer(gold_bio,
         The k nearest neighbors to consider in the knn experiment.
     batch_size : int, optional, default 250
         The batch size to use.
+    n_jobs : int, optional, default 1
+        The number of threads over which the batches are divided.
+    encoded : bool, optional, default False
+        Whether to return the labels as integer arrays instead of strings.
+    checkpoint : str, optional, default None
+        If this is not None, the neighbors are written to a checkpoint in
+        this directory as batches finish. A run which is interrupted
+        resumes from the last checkpoint when it is started again.
+    checkpoint_interval : float, optional, default 60
+        The minimum number of seconds between two checkpoints.
 
     Returns
     =======
     neighbors : list of lists
         The labels of the k nearest neighbors, which can then be used in
-        subsequent scoring functions.
+        subsequent scoring functions. If encoded is True, a tuple of
+        (labels, gold, neighbors) arrays is returned instead, in the format
+        of knn.encode_knn.
 
     """
-    train_embeddings, words2label, _, _ = label_chunks(gold_bio,
-                                                       phrase_bio,
-                                                       train_embeddings)
-
-    test_embeddings, _, phrase_labels, results = label_chunks(gold_bio_test,
-                                                              phrase_bio_test,
-                                                              test_embeddings)
-
-    return produce_eval(phrase_labels,
-                        test_embeddings,
-                        train_embeddings,
-                        words2label,
-                        k,
-                        results,
-                        batch_size,
-                        0)
+    table = _label_table(gold_bio, gold_bio_test)
+
+    train_codes, _ = _link_codes(gold_bio, phrase_bio, table)
+    test_codes, fn_codes = _link_codes(gold_bio_test, phrase_bio_test, table)
+
+    # False positives get the label "o", so they are removed.
+    o = np.searchsorted(table, "o")
+    train_allowed = np.flatnonzero(train_codes != o)
+    test_allowed = np.flatnonzero(test_codes != o)
+
+    # The pruned rows are not copied, but skipped during the search.
+    neighbors = _neighbor_codes(test_embeddings.norm_vectors,
+                                test_allowed,
+                                train_embeddings.norm_vectors,
+                                train_codes,
+                                train_codes == o,
+                                k,
+                                0,
+                                o,
+                                batch_size,
+                                n_jobs,
+                                checkpoint,
+                                checkpoint_interval)
+
+    return _results(table,
+                    fn_codes,
+                    test_codes[test_allowed],
+                    neighbors,
+                    encoded)
 
 
 def evaluate_intrinsic(gold_bio,
                        phrase_bio,
                        embeddings,
                        k=10,
-                       batch_size=250):
+                       batch_size=250,
+                       block_size=None,
+                       path=None,
+                       n_jobs=1,
+                       encoded=False,
+                       checkpoint=None,
+                       checkpoint_interval=60):
     """
     Do a transfer experiment between corpora.
 
@@ -100,28 +143,62 @@ def evaluate_intrinsic(gold_bio,
         The k nearest neighbors to consider in the knn experiment.
     batch_size : int, optional, default 250
         The batch size to use.
+    block_size : int, optional, default None
+        If this is not None, the neighbors are found with a blocked search
+        of the space against itself, which computes each pair of blocks
+        once. See knn.self_knn.
+    path : str, optional, default None
+        A directory to which the blocked search writes its partial
+        neighbors. Only used if block_size is not None.
+    n_jobs : int, optional, default 1
+        The number of threads over which the batches are divided.
+    encoded : bool, optional, default False
+        Whether to return the labels as integer arrays instead of strings.
+    checkpoint : str, optional, default None
+        A directory for checkpoints of the batched search, see
+        evaluate_transfer. Not used by the blocked search, which has its
+        own partial results in path.
+    checkpoint_interval : float, optional, default 60
+        The minimum number of seconds between two checkpoints.
 
     Returns
     =======
     neighbors : list of lists
         The labels of the k nearest neighbors, which can then be used in
-        subsequent scoring functions.
+        subsequent scoring functions. If encoded is True, a tuple of
+        (labels, gold, neighbors) arrays is returned instead, in the format
+        of knn.encode_knn.
 
     """
-    embeddings, words2label, phrase_labels, results = label_chunks(gold_bio,
-                                                                   phrase_bio,
-                                                                   embeddings)
-
-    results = [(x, [y] * k) for x, y in results]
-
-    return produce_eval(phrase_labels,
-                        embeddings,
-                        embeddings,
-                        words2label,
-                        k,
-                        results,
-                        batch_size,
-                        1)
+    table = _label_table(gold_bio)
+    phrase_codes, fn_codes = _link_codes(gold_bio, phrase_bio, table)
+
+    # False positives get the label "o", so they are removed.
+    o = np.searchsorted(table, "o")
+    allowed = np.flatnonzero(phrase_codes != o)
+    chunk_codes = phrase_codes[allowed]
+    # The pruned rows are not copied, but skipped during the search.
+    vectors = embeddings.norm_vectors
+
+    if block_size is not None:
+        indices, _ = self_knn(vectors, k, block_size, path, rows=allowed)
+        neighbors = chunk_codes[indices]
+        neighbors[~vectors.any(1)[allowed]] = o
+    else:
+        neighbors = _neighbor_codes(vectors,
+                                    allowed,
+                                    vectors,
+                                    phrase_codes,
+                                    phrase_codes == o,
+                                    k,
+                                    1,
+                                    o,
+                                    batch_size,
+                                    n_jobs,
+                                    checkpoint,
+                                    checkpoint_interval)
+
+    return _results(table, fn_codes, chunk_codes, neighbors, encoded)
 
 
 def label_chunks(gold_bio,
@@ -157,30 +234,259 @@ def label_chunks(gold_bio,
         during matching the gold and phrase chunks.
 
     """
-    # Create a list of (start, end, label) tuples from BIO.
-    phrase_chunks = bio_to_index(phrase_bio)
-    gold_chunks = bio_to_index(gold_bio)
-    phrase_labels, results = link_chunks_to_gold(phrase_chunks, gold_chunks)
+    table = _label_table(gold_bio)
+    phrase_codes, fn_codes = _link_codes(gold_bio, phrase_bio, table)
 
     # False positives get assigned the label "o", so they need to be removed.
-    allowed = [i for i, v in enumerate(phrase_labels) if v != "o"]
+    allowed = np.flatnonzero(phrase_codes != np.searchsorted(table, "o"))
 
-    if results:
-        t, _ = zip(*results)
-        print("Num false neg: {0}".format(Counter(t)))
+    results = [(x, "np") for x in table[fn_codes].tolist()]
 
     # We assume alignment between chunks and words.
-    vectors = embeddings.norm_vectors[allowed]
-    chunk_labels = np.array(phrase_labels)[allowed]
+    chunk_labels = table[phrase_codes[allowed]]
     words = [embeddings.indices[x] for x in allowed]
     words2label = {embeddings.indices[x]: chunk_labels[idx]
                    for idx, x in enumerate(allowed)}
 
-    pruned_embeddings = Reach(vectors, words)
+    # The rows are already unit vectors, so they are only copied once, and
+    # not normalized again.
+    vectors = embeddings.norm_vectors[allowed]
+    pruned_embeddings = reach_from_arrays(vectors, vectors, words)
 
     return pruned_embeddings, words2label, chunk_labels, results
 
 
+def _label_table(*gold_bios):
+    """Create a sorted table of all labels, including "np" and "o"."""
+    labels = {"np", "o"}
+    for gold_bio in gold_bios:
+        if isinstance(gold_bio, Corpus):
+            # The tag table contains every tag which occurs in the corpus.
+            gold_bio = [gold_bio.tags]
+        for bio in gold_bio:
+            labels.update(x.split("-")[1] for x in bio if x.startswith("B"))
+
+    return np.array(sorted(labels))
+
+
+def _link_codes(gold_bio, phrase_bio, table):
+    """
+    Label all phrase chunks by comparing them to the gold chunks.
+
+    This is a vectorized version of link_chunks_to_gold, which gives the
+    same labels. The chunks of all documents are put on a single axis, so
+    that the overlap between all chunks can be found using a single sorted
+    search.
+
+    Parameters
+    ==========
+    gold_bio : list of lists of strings or Corpus
+        The BIO strings of the gold standard data.
+    phrase_bio : list of lists of strings or Corpus
+        The BIO strings of the chunked data.
+    table : np.array
+        The sorted label table.
+
+    Returns
+    =======
+    phrase_codes : np.array
+        The label code of each phrase chunk.
+    fn_codes : np.array
+        The label code of each false negative gold chunk.
+
+    """
+    gold, gold_labels, phrase, _ = align_chunks(gold_bio, phrase_bio)
+
+    dtype = code_dtype(len(table))
+    gold_codes = np.searchsorted(table, gold_labels).astype(dtype)
+    o, np_code = np.searchsorted(table, ["o", "np"]).astype(dtype)
+
+    num_gold, first_gold = overlaps(phrase, gold)
+    num_phrase, first_phrase = overlaps(gold, phrase)
+
+    # Phrases without gold chunks are "np", and phrases overlapping with
+    # multiple gold chunks are "o".
+    phrase_codes = np.full(len(phrase), np_code, dtype=dtype)
+    phrase_codes[num_gold > 1] = o
+
+    # Phrases with a single gold chunk only get its label if that gold
+    # chunk does not overlap with any other phrase.
+    single = np.flatnonzero(num_gold == 1)
+    match = first_gold[single]
+    phrase_codes[single] = np.where(num_phrase[match] == 1,
+                                    gold_codes[match],
+                                    o)
+
+    # Gold chunks which are not the only chunk of their only phrase are
+    # false negatives.
+    touched = num_phrase == 1
+    touched[touched] = num_gold[first_phrase[touched]] == 1
+    fn_codes = gold_codes[~touched]
+
+    if len(fn_codes):
+        print("Num false neg: {0}".format(Counter(table[fn_codes].tolist())))
+
+    # We need the number of illegal and legal pred chunks to be equal to the
+    # number of gold chunks.
+    legal = np.sum((phrase_codes != o) & (phrase_codes != np_code))
+    assert legal + len(fn_codes) == len(gold)
+
+    return phrase_codes, fn_codes
+
+
+def _neighbor_codes(vectors,
+                    rows,
+                    reference_vectors,
+                    reference_codes,
+                    excluded,
+                    k,
+                    add,
+                    fill,
+                    batch_size,
+                    n_jobs,
+                    checkpoint=None,
+                    checkpoint_interval=60):
+    """
+    Find the label codes of the k nearest neighbors of each vector.
+
+    Parameters
+    ==========
+    vectors : np.array
+        A matrix of unit vectors.
+    rows : np.array
+        The rows of vectors to find neighbors for.
+    reference_vectors : np.array
+        The unit vectors in which to look for neighbors.
+    reference_codes : np.array
+        The label code of each reference vector.
+    excluded : np.array
+        A boolean mask of the reference vectors which are never neighbors.
+    k : int
+        The number of neighbors. Like in knn.self_knn, this is clamped to
+        the number of reference vectors which are not excluded, minus
+        add, so excluded vectors are never neighbors.
+    add : int
+        The number of nearest neighbors to skip, e.g. 1 if vectors is the
+        same space as reference_vectors.
+    fill : int
+        The label code given to all neighbors of zero vectors.
+    batch_size : int
+        The batch size to use.
+    n_jobs : int
+        The number of threads over which the batches are divided.
+    checkpoint : str, optional, default None
+        A directory in which to checkpoint the neighbors.
+    checkpoint_interval : float, optional, default 60
+        The minimum number of seconds between two checkpoints.
+
+    Returns
+    =======
+    neighbors : np.array
+        An array of shape (rows, k) of label codes, with k clamped.
+
+    """
+    excluded = np.flatnonzero(excluded)
+    k = max(min(k, len(reference_codes) - len(excluded) - add), 0)
+
+    num = len(rows)
+    if checkpoint is None:
+        neighbors = np.empty((num, k), dtype=reference_codes.dtype)
+        start = 0
+    else:
+        # A resumed run must search the same vectors for the same rows.
+        state = Checkpoint(checkpoint,
+                           "neighbors",
+                           (num, k),
+                           reference_codes.dtype,
+                           {"vectors": digest(vectors),
+                            "rows": digest(rows),
+                            # The reference is usually the same matrix.
+                            "reference": (None
+                                          if reference_vectors is vectors
+                                          else digest(reference_vectors)),
+                            "codes": digest(reference_codes),
+                            "add": add},
+                           checkpoint_interval)
+        neighbors, start = state.out, state.done
+    code_batch = partial(_code_batch,
+                         vectors=vectors,
+                         rows=rows,
+                         reference_vectors=reference_vectors,
+                         reference_codes=reference_codes,
+                         excluded=excluded,
+                         add=add,
+                         fill=fill,
+                         out=neighbors)
+    batches = map_batches(code_batch, num, batch_size, n_jobs, start)
+
+    end, skipped = start, 0
+    for batch_skipped in tqdm(batches, total=num_batches(num - start,
+                                                         batch_size)):
+        end = min(end + batch_size, num)
+        skipped += batch_skipped
+        if checkpoint is not None:
+            state.update(end)
+
+    report_skipped(skipped, num - start)
+
+    if checkpoint is None:
+        return neighbors
+
+    state.save()
+    return np.array(neighbors)
+
+
+def _code_batch(begin,
+                end,
+                vectors,
+                rows,
+                reference_vectors,
+                reference_codes,
+                excluded,
+                add,
+                fill,
+                out):
+    """Write the label codes of the neighbors of a batch to out."""
+    k = out.shape[1]
+    # Search in the dtype of the reference vectors, so a mismatch between
+    # the spaces never upcasts the whole product.
+    batch = vectors[rows[begin:end]].astype(reference_vectors.dtype,
+                                            copy=False)
+
+    # Zero vectors only get the fill code, so they are not searched.
+    nonzero = batch.any(1)
+    out[begin:end][~nonzero] = fill
+    if not nonzero.all():
+        batch = batch[nonzero]
+
+    # Compute the distances from the current batch to all other vectors.
+    distances = batch.dot(reference_vectors.T)
+    # Sort on the negated distances in place, instead of on a negated copy.
+    np.negative(distances, out=distances)
+    distances[:, excluded] = np.inf
+    closest = np.argsort(distances, axis=1)[:, add:k+add]
+    out[begin:end][nonzero] = reference_codes[closest]
+
+    return len(nonzero) - len(batch)
+
+
+def _results(table, fn_codes, chunk_codes, neighbors, encoded):
+    """Put the false negatives and chunks together, and decode them."""
+    k = neighbors.shape[1]
+    np_code = np.searchsorted(table, "np").astype(neighbors.dtype)
+    # False negatives have "np" as their label at every k.
+    gold = np.concatenate([fn_codes, chunk_codes])
+    neighbors = np.concatenate([np.full((len(fn_codes), k),
+                                        np_code,
+                                        dtype=neighbors.dtype),
+                                neighbors])
+
+    if encoded:
+        return table, gold, neighbors
+
+    return list(zip(table[gold].tolist(), table[neighbors].tolist()))
+
+
 def produce_eval(phrase_labels,
                  embeddings,
                  reference_embeddings,
@@ -188,25 +494,63 @@ def produce_eval(phrase_labels,
                  k=1,
                  results=((), ()),
                  batch_size=250,
-                 add=1):
-    """Produce the actual evaluation."""
-    for batch in tqdm(range(0, len(embeddings.norm_vectors), batch_size)):
+                 add=1,
+                 n_jobs=1):
+    """
+    Produce the actual evaluation.
 
-        labels = phrase_labels[batch:batch+batch_size]
+    If n_jobs is larger than 1, batches are searched in a thread pool.
+    The order of the results does not depend on n_jobs.
+    """
+    eval_batch = partial(_eval_batch,
+                         phrase_labels=phrase_labels,
+                         embeddings=embeddings,
+                         reference_embeddings=reference_embeddings,
+                         words2label=words2label,
+                         k=k,
+                         add=add)
+    num = len(embeddings.norm_vectors)
+    batches = map_batches(eval_batch, num, batch_size, n_jobs)
+
+    skipped = 0
+    for batch, batch_skipped in tqdm(batches,
+                                     total=num_batches(num, batch_size)):
+        results.extend(batch)
+        skipped += batch_skipped
+
+    report_skipped(skipped, num)
 
-        batch = embeddings.norm_vectors[batch:batch+batch_size]
+    return results
 
-        # Compute the distances from the current batch to all other vectors.
-        r = reference_embeddings.nearest_neighbor(batch, num=k+add)
-        for result, label, vec in zip(r, labels, batch):
-            if not vec.any():
-                results.append((label, ["o"] * k))
-                continue
 
-            closest = [words2label[x[0]] for x in result[add:]]
-            results.append((label, closest))
+def _eval_batch(begin,
+                end,
+                phrase_labels,
+                embeddings,
+                reference_embeddings,
+                words2label,
+                k,
+                add):
+    """Find the labels of the neighbors of a single batch."""
+    results = []
+    labels = phrase_labels[begin:end]
+    batch = embeddings.norm_vectors[begin:end]
+    # Zero vectors only get the label "o", so they are not searched.
+    nonzero = batch.any(1)
+
+    # Compute the distances from the current batch to all other vectors.
+    r = iter(reference_embeddings.nearest_neighbor(batch[nonzero],
+                                                   num=k+add)
+             if nonzero.any() else [])
+    for label, vec_nonzero in zip(labels, nonzero.tolist()):
+        if not vec_nonzero:
+            results.append((label, ["o"] * k))
+            continue
 
-    return results
+        closest = [words2label[x[0]] for x in next(r)[add:]]
+        results.append((label, closest))
+
+    return results, len(nonzero) - int(nonzero.sum())
 
 
 def calculate_shared(a, b):
@@ -0,0 +1,204 @@
+"""Blocked nearest neighbor search of a vector space against itself."""
+import os
+import numpy as np
+
+
+def self_knn(vectors, k, block_size=4096, path=None, rows=None):
+    """
+    Find the k nearest neighbors of each vector in a space, excluding itself.
+
+    The similarity matrix is computed in blocks. Because the similarity is
+    symmetric, each pair of blocks is only computed once, and is used to
+    update the neighbors of both blocks. The space is only read a block at
+    a time, so it can be memory-mapped.
+
+    Parameters
+    ==========
+    vectors : np.array or str
+        A matrix of unit vectors, or the path to a .npy file containing
+        such a matrix, which is then memory-mapped.
+    k : int
+        The number of neighbors to find.
+    block_size : int, optional, default 4096
+        The number of vectors in a block.
+    path : str, optional, default None
+        A directory in which the partial neighbors are stored as
+        memory-mapped files. If this is None, they are kept in memory.
+    rows : np.array, optional, default None
+        If this is not None, only these rows of vectors are searched, and
+        the neighbors are indices into rows. The rows are read a block at a
+        time, so the matrix is never copied as a whole.
+
+    Returns
+    =======
+    indices : np.array
+        An array of shape (vectors, k) with the indices of the nearest
+        neighbors of each vector, ordered by decreasing similarity.
+    similarities : np.array
+        An array of shape (vectors, k) with the similarities of the
+        nearest neighbors.
+
+    """
+    if isinstance(vectors, str):
+        vectors = np.load(vectors, mmap_mode="r")
+
+    if rows is None:
+        rows = np.arange(len(vectors))
+
+    num = len(rows)
+    k = max(min(k, num - 1), 0)
+    dtype = vectors.dtype
+
+    if path is None:
+        top_sim = np.full((num, k), -np.inf, dtype=dtype)
+        top_idx = np.full((num, k), -1, dtype=np.int64)
+    else:
+        top_sim = np.lib.format.open_memmap(os.path.join(path,
+                                                         "knn_sim.npy"),
+                                            mode="w+",
+                                            dtype=dtype,
+                                            shape=(num, k))
+        top_idx = np.lib.format.open_memmap(os.path.join(path,
+                                                         "knn_idx.npy"),
+                                            mode="w+",
+                                            dtype=np.int64,
+                                            shape=(num, k))
+        top_sim[:] = -np.inf
+        top_idx[:] = -1
+
+    if k == 0:
+        return top_idx, top_sim
+
+    for i in range(0, num, block_size):
+
+        block_i = np.asarray(vectors[rows[i:i+block_size]])
+
+        for j in range(i, num, block_size):
+
+            if i == j:
+                block_j = block_i
+            else:
+                block_j = np.asarray(vectors[rows[j:j+block_size]])
+
+            sim = block_i.dot(block_j.T)
+
+            if i == j:
+                # A vector is not its own neighbor.
+                np.fill_diagonal(sim, -np.inf)
+            else:
+                _merge(top_sim, top_idx, j, sim.T, i)
+            _merge(top_sim, top_idx, i, sim, j)
+
+    # Order the neighbors of each vector from most to least similar.
+    for i in range(0, num, block_size):
+        block = slice(i, i + block_size)
+        lines = np.arange(len(top_sim[block]))[:, None]
+        order = np.argsort(-top_sim[block], axis=1, kind="mergesort")
+        top_sim[block] = top_sim[block][lines, order]
+        top_idx[block] = top_idx[block][lines, order]
+
+    return top_idx, top_sim
+
+
+def _merge(top_sim, top_idx, start, sim, offset):
+    """Merge a block of similarities into the current nearest neighbors."""
+    rows = slice(start, start + len(sim))
+    k = top_sim.shape[1]
+
+    columns = np.arange(offset, offset + sim.shape[1])
+    candidate_sim = np.concatenate([top_sim[rows], sim], axis=1)
+    candidate_idx = np.concatenate([top_idx[rows],
+                                    np.broadcast_to(columns, sim.shape)],
+                                   axis=1)
+
+    best = np.argpartition(-candidate_sim, k - 1, axis=1)[:, :k]
+    lines = np.arange(len(sim))[:, None]
+    top_sim[rows] = candidate_sim[lines, best]
+    top_idx[rows] = candidate_idx[lines, best]
+
+
+def code_dtype(num_labels):
+    """Get the smallest integer dtype which can hold num_labels codes."""
+    if num_labels <= np.iinfo(np.uint8).max + 1:
+        return np.uint8
+    elif num_labels <= np.iinfo(np.int16).max + 1:
+        return np.int16
+    return np.int32
+
+
+def encode_knn(results):
+    """
+    Encode the labels of a knn experiment as integers.
+
+    Parameters
+    ==========
+    results : list of tuples
+        A list of (label, neighbors) tuples, where neighbors is a list of
+        the labels of the k nearest neighbors, as returned by
+        evaluate_intrinsic or evaluate_transfer.
+
+    Returns
+    =======
+    labels : np.array
+        The sorted label table.
+    gold : np.array
+        The label code of each item.
+    neighbors : np.array
+        An array of shape (items, k) with the label codes of the neighbors
+        of each item. The dtype is uint8 if there are at most 256 labels.
+
+    """
+    true, pred = zip(*results)
+    labels = sorted(set(true).union(*[set(x) for x in pred]))
+    codes = {label: idx for idx, label in enumerate(labels)}
+
+    dtype = code_dtype(len(labels))
+
+    gold = np.array([codes[x] for x in true], dtype=dtype)
+    neighbors = np.array([[codes[x] for x in p] for p in pred], dtype=dtype)
+    # All items need the same number of neighbors.
+    assert neighbors.ndim == 2
+
+    return np.array(labels), gold, neighbors
+
+
+def save_knn(path, results):
+    """
+    Save the labels of a knn experiment in .npz format.
+
+    Parameters
+    ==========
+    path : str
+        The path to save to.
+    results : list of tuples or tuple of arrays
+        Either a list of (label, neighbors) tuples, or the output of
+        encode_knn.
+
+    """
+    if len(results) != 3 or not isinstance(results[0], np.ndarray):
+        results = encode_knn(results)
+    labels, gold, neighbors = results
+    np.savez(path, labels=labels, gold=gold, neighbors=neighbors)
+
+
+def load_knn(path):
+    """
+    Load the labels of a knn experiment saved with save_knn.
+
+    Parameters
+    ==========
+    path : str
+        The path to load from.
+
+    Returns
+    =======
+    labels : np.array
+        The sorted label table.
+    gold : np.array
+        The label code of each item.
+    neighbors : np.array
+        The label codes of the neighbors of each item.
+
+    """
+    f = np.load(path)
+    return f["labels"], f["gold"], f["neighbors"]
@@ -1,7 +1,10 @@
 """Simple evaluation script."""
-from .utils import bio_to_index
+import numpy as np
+
+from conch.corpus import Corpus
+from .utils import bio_to_spans
 from collections import Counter, defaultdict
-from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
 
 
 def precision_recall_dict(tp, fp, fn, average=None):
@@ -35,47 +38,167 @@ def precision_recall_dict(tp, fp, fn, average=None):
     return precision, recall, f1
 
 
-def eval_sequence(gold_bio, pred_bio, exact=True):
-    """Evaluate sequences on the basis of BIO strings."""
-    assert len(gold_bio) == len(pred_bio)
-
-    if not isinstance(gold_bio[0], list):
-        gold_bio = [gold_bio]
-        pred_bio = [pred_bio]
-
-    for x, y in zip(gold_bio, pred_bio):
-        assert len(x) == len(y)
+class SequenceEvaluator(object):
+    """
+    Streaming evaluation of BIO sequences.
 
-    gold_index = [set(x) for x in bio_to_index(gold_bio)]
-    pred_index = [set(x) for x in bio_to_index(pred_bio)]
+    Documents are passed one at a time using update. Chunks are stored as
+    integer arrays, and only the running true positive, false positive and
+    false negative counts per label are kept.
 
-    tp, fp, fn = Counter(), Counter(), Counter()
+    Parameters
+    ==========
+    exact : bool, optional, default True
+        Whether to use exact or inexact matching.
 
-    if exact:
+    Attributes
+    ==========
+    label_codes : dict
+        A dictionary mapping from labels to integer codes.
+    num_gold : int
+        The number of gold chunks seen so far.
+    num_pred : int
+        The number of predicted chunks seen so far.
 
-        for g, p in zip(gold_index, pred_index):
+    """
 
-            tp_, fp_, fn_ = eval_triples_exact(g, p)
-            tp.update(tp_)
-            fp.update(fp_)
-            fn.update(fn_)
+    def __init__(self, exact=True):
+        """Initialize an empty evaluator."""
+        self.exact = exact
+        self.label_codes = {}
+        self.num_gold = 0
+        self.num_pred = 0
+        self._counts = np.zeros((3, 0), dtype=np.int64)
+
+    def update(self, gold_bio, pred_bio):
+        """
+        Add a single document.
+
+        Parameters
+        ==========
+        gold_bio : list of string
+            The gold BIO tags of the document.
+        pred_bio : list of string
+            The predicted BIO tags of the document. Must be as long as
+            gold_bio.
+
+        Returns
+        =======
+        counts : np.array
+            An array of shape (3, labels) containing the true positives,
+            false positives and false negatives of this document for each
+            label code.
+
+        """
+        assert len(gold_bio) == len(pred_bio)
+
+        gold = bio_to_spans(gold_bio, self.label_codes)
+        pred = bio_to_spans(pred_bio, self.label_codes)
+
+        if self.exact:
+            tp = self._match_exact(gold, pred, len(gold_bio))
+        else:
+            tp = self._match_inexact(gold, pred, gold_bio, pred_bio)
+
+        num_labels = len(self.label_codes)
+        fp = np.bincount(pred[:, 2], minlength=num_labels) - tp
+        fn = np.bincount(gold[:, 2], minlength=num_labels) - tp
+
+        counts = np.stack([tp, fp, fn])
+        if num_labels > self._counts.shape[1]:
+            grow = num_labels - self._counts.shape[1]
+            self._counts = np.pad(self._counts,
+                                  ((0, 0), (0, grow)),
+                                  "constant")
+        self._counts += counts
+        self.num_gold += len(gold)
+        self.num_pred += len(pred)
+
+        return counts
+
+    def _match_exact(self, gold, pred, length):
+        """Count the chunks which are in gold and pred per label code."""
+        num_labels = len(self.label_codes)
+
+        # Turn each (begin, end, label) triple into a single integer key.
+        def keys(x):
+            return (x[:, 0] * (length + 1) + x[:, 1]) * num_labels + x[:, 2]
+
+        shared = np.intersect1d(keys(gold), keys(pred), assume_unique=True)
+        return np.bincount(shared % num_labels, minlength=num_labels)
+
+    def _match_inexact(self, gold, pred, gold_bio, pred_bio):
+        """Return the number of overlapping chunks per label code."""
+        tp_p = self._covered(pred, gold_bio)
+        tp_g = self._covered(gold, pred_bio)
+
+        return np.minimum(tp_p, tp_g)
+
+    def _covered(self, spans, bio):
+        """Count the chunks whose label occurs in the other sequence."""
+        num_labels = len(self.label_codes)
+        # Labels without a chunk can never cover one, so they are skipped.
+        tokens = np.array([-1 if x == "O" else
+                           self.label_codes.get(x.split("-")[-1], -1)
+                           for x in bio], dtype=np.int64)
+
+        # The cumulative count of each label lets us count the occurrences
+        # of a label in any range of tokens with a single subtraction.
+        positions = np.flatnonzero(tokens >= 0)
+        cumulative = np.zeros((len(bio) + 1, num_labels), dtype=np.int64)
+        cumulative[positions + 1, tokens[positions]] = 1
+        cumulative = cumulative.cumsum(0)
+
+        begin, end, label = spans.T
+        inside = cumulative[end, label] - cumulative[begin, label] > 0
+
+        return np.bincount(label[inside], minlength=num_labels)
+
+    def counts(self):
+        """
+        Get the counts of all documents seen so far.
+
+        Returns
+        =======
+        tp : Counter
+            The number of true positives per label.
+        fp : Counter
+            The number of false positives per label.
+        fn : Counter
+            The number of false negatives per label.
+
+        """
+        tp, fp, fn = self._counts
+
+        # Sanity checks.
+        assert tp.sum() + fp.sum() == self.num_pred
+        assert tp.sum() + fn.sum() == self.num_gold
+
+        labels = sorted(self.label_codes, key=self.label_codes.get)
+
+        return tuple(Counter({labels[idx]: int(v)
+                              for idx, v in enumerate(x) if v > 0})
+                     for x in (tp, fp, fn))
 
-    else:
 
-        for g, p, gb, pb in zip(gold_index, pred_index, gold_bio, pred_bio):
+def eval_sequence(gold_bio, pred_bio, exact=True):
+    """Evaluate sequences on the basis of BIO strings."""
+    assert len(gold_bio) == len(pred_bio)
 
-            tp_, fp_, fn_ = eval_inexact(g, p, gb, pb)
-            tp.update(tp_)
-            fp.update(fp_)
-            fn.update(fn_)
+    # Documents of a corpus are decoded one at a time.
+    if isinstance(gold_bio, Corpus):
+        gold_bio = map(gold_bio.bio, range(len(gold_bio)))
+    if isinstance(pred_bio, Corpus):
+        pred_bio = map(pred_bio.bio, range(len(pred_bio)))
+    if isinstance(gold_bio, list) and not isinstance(gold_bio[0], list):
+        gold_bio = [gold_bio]
+        pred_bio = [pred_bio]
 
-    # Sanity checks.
-    num_pred = len(list(chain.from_iterable(pred_index)))
-    num_gold = len(list(chain.from_iterable(gold_index)))
-    assert sum(tp.values()) + sum(fp.values()) == num_pred
-    assert sum(tp.values()) + sum(fn.values()) == num_gold
+    evaluator = SequenceEvaluator(exact)
+    for x, y in zip(gold_bio, pred_bio):
+        evaluator.update(x, y)
 
-    return tp, fp, fn
+    return evaluator.counts()
 
 
 def eval_triples_exact(gold_index, pred_index):
@@ -113,13 +236,9 @@ def eval_inexact(gold_index, pred_index, gold_bio, pred_bio):
     return tp, fp, fn
 
 
-def sigf_evaluation_output(gold_bio, pred_bio, out_path, exact=True):
+def document_counts(gold_bio, pred_bio, exact=True):
     """
-    Produce an output file with the output format for sigf.
-
-    https://nlpado.de/~sebastian/software/sigf.shtml
-    Sigf takes a triple of three numbers for each document and a given
-    system: (TP, # predicted, # gold)
+    Count the true positives, predictions and gold chunks per document.
 
     Parameters
     ==========
@@ -127,8 +246,15 @@ def sigf_evaluation_output(gold_bio, pred_bio, out_path, exact=True):
         A list of list of BIO tags
     pred_bio : list of list
         A list of list of BIO tags
-    out_path : str
-        The path to write the sigf output to.
+    exact : bool, optional, default True
+        Whether to use exact or inexact matching.
+
+    Returns
+    =======
+    counts : np.array
+        An array of shape (documents, 3), where each row contains the
+        number of true positives, predicted chunks and gold chunks of a
+        document.
 
     """
     if not isinstance(gold_bio[0], list):
@@ -136,27 +262,230 @@ def sigf_evaluation_output(gold_bio, pred_bio, out_path, exact=True):
     if not isinstance(pred_bio[0], list):
         pred_bio = [pred_bio]
 
-    gold_index = [set(x) for x in bio_to_index(gold_bio)]
-    pred_index = [set(x) for x in bio_to_index(pred_bio)]
+    evaluator = SequenceEvaluator(exact)
+    counts = np.zeros((len(gold_bio), 3), dtype=np.int64)
+
+    for idx, (g, p) in enumerate(zip(gold_bio, pred_bio)):
+
+        tp, fp, fn = evaluator.update(g, p).sum(1)
+        counts[idx] = tp, tp + fp, tp + fn
 
-    f = open(out_path, 'w')
+    return counts
 
-    if exact:
 
-        for g, p in zip(gold_index, pred_index):
+def f_score(counts):
+    """
+    Calculate the micro F-score from (TP, # predicted, # gold) counts.
+
+    Parameters
+    ==========
+    counts : np.array
+        An array whose last dimension contains the number of true
+        positives, predicted chunks and gold chunks.
 
-            tp, fp, fn = eval_triples_exact(g, p)
-            tp = sum(tp.values())
-            fp = sum(fp.values())
-            fn = sum(fn.values())
-            f.write("{} {} {}\n".format(tp, fp + tp, fn + tp))
+    Returns
+    =======
+    f1 : np.array
+        The F-score for each row of counts.
 
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    tp = counts[..., 0]
+    denominator = counts[..., 1] + counts[..., 2]
+    # F1 == 2TP / (# predicted + # gold), and 0 if there is nothing.
+    return np.divide(2 * tp,
+                     denominator,
+                     out=np.zeros_like(tp),
+                     where=denominator > 0)
+
+
+def _randomization_statistics(counts_a, counts_b, num, seed):
+    """Compute the F-score differences for num random swaps."""
+    rng = np.random.RandomState(seed)
+    diff = counts_b - counts_a
+
+    # Each row swaps the outputs of both systems on a random set of
+    # documents, which amounts to adding or subtracting their difference.
+    swaps = rng.randint(0, 2, size=(num, len(counts_a))).astype(diff.dtype)
+    shift = swaps.dot(diff)
+    a = counts_a.sum(0) + shift
+    b = counts_b.sum(0) - shift
+
+    return np.abs(f_score(a) - f_score(b))
+
+
+def _bootstrap_statistics(counts_a, counts_b, num, seed):
+    """Compute the F-scores of num bootstrap resamples of the documents."""
+    rng = np.random.RandomState(seed)
+    num_docs = len(counts_a)
+
+    # Each row contains the number of times a document is drawn.
+    weights = rng.multinomial(num_docs,
+                              np.ones(num_docs) / num_docs,
+                              size=num)
+    scores = f_score(weights.dot(counts_a))
+    if counts_b is not None:
+        scores -= f_score(weights.dot(counts_b))
+
+    return scores
+
+
+def _resample(function, counts_a, counts_b, num, seed, n_jobs, batch_size):
+    """Run a resampling function in batches, optionally in parallel."""
+    # Seeds are drawn per batch, so the results do not depend on n_jobs.
+    rng = np.random.RandomState(seed)
+    sizes = [min(batch_size, num - x) for x in range(0, num, batch_size)]
+    seeds = rng.randint(0, 2**31 - 1, size=len(sizes))
+    args = [(counts_a, counts_b, n, s) for n, s in zip(sizes, seeds)]
+
+    if n_jobs == 1:
+        results = [function(*x) for x in args]
     else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(function, *zip(*args)))
+
+    return np.concatenate(results)
+
+
+def approximate_randomization(counts_a,
+                              counts_b,
+                              num_permutations=10000,
+                              seed=None,
+                              n_jobs=1,
+                              batch_size=1000):
+    """
+    Perform a paired approximate randomization test on the micro F-score.
 
-        for g, p, gb, pb in zip(gold_index, pred_index, gold_bio, pred_bio):
+    This replaces the sigf round trip: the counts can be obtained using
+    document_counts.
 
-            tp, fp, fn = eval_inexact(g, p, gb, pb)
-            tp = sum(tp.values())
-            fp = sum(fp.values())
-            fn = sum(fn.values())
-            f.write("{} {} {}\n".format(tp, fp + tp, fn + tp))
+    Parameters
+    ==========
+    counts_a : np.array
+        The (TP, # predicted, # gold) counts per document of system a.
+    counts_b : np.array
+        The (TP, # predicted, # gold) counts per document of system b.
+        Must be aligned with counts_a.
+    num_permutations : int, optional, default 10000
+        The number of random permutations.
+    seed : int, optional, default None
+        The random seed.
+    n_jobs : int, optional, default 1
+        The number of processes to use.
+    batch_size : int, optional, default 1000
+        The number of permutations which are computed at the same time.
+
+    Returns
+    =======
+    difference : float
+        The observed difference in F-score between a and b.
+    p : float
+        The p-value of the difference.
+
+    """
+    counts_a = np.asarray(counts_a, dtype=np.int64)
+    counts_b = np.asarray(counts_b, dtype=np.int64)
+    assert counts_a.shape == counts_b.shape
+
+    difference = f_score(counts_a.sum(0)) - f_score(counts_b.sum(0))
+    statistics = _resample(_randomization_statistics,
+                           counts_a,
+                           counts_b,
+                           num_permutations,
+                           seed,
+                           n_jobs,
+                           batch_size)
+
+    # Small tolerance, because equal differences can be computed in a
+    # different order.
+    extreme = np.sum(statistics >= abs(difference) - 1e-12)
+    p = (extreme + 1) / (num_permutations + 1)
+
+    return float(difference), float(p)
+
+
+def bootstrap_interval(counts_a,
+                       counts_b=None,
+                       num_samples=10000,
+                       alpha=.05,
+                       seed=None,
+                       n_jobs=1,
+                       batch_size=1000):
+    """
+    Calculate a bootstrap confidence interval of the micro F-score.
+
+    Documents are resampled with replacement. If counts_b is passed,
+    the interval is calculated for the paired difference in F-score
+    between a and b.
+
+    Parameters
+    ==========
+    counts_a : np.array
+        The (TP, # predicted, # gold) counts per document of system a.
+    counts_b : np.array, optional, default None
+        The (TP, # predicted, # gold) counts per document of system b.
+        Must be aligned with counts_a.
+    num_samples : int, optional, default 10000
+        The number of bootstrap samples.
+    alpha : float, optional, default .05
+        The significance level, e.g. .05 gives a 95% interval.
+    seed : int, optional, default None
+        The random seed.
+    n_jobs : int, optional, default 1
+        The number of processes to use.
+    batch_size : int, optional, default 1000
+        The number of samples which are computed at the same time.
+
+    Returns
+    =======
+    score : float
+        The F-score, or the difference in F-score, on the original data.
+    lower : float
+        The lower bound of the interval.
+    upper : float
+        The upper bound of the interval.
+
+    """
+    counts_a = np.asarray(counts_a, dtype=np.int64)
+    score = f_score(counts_a.sum(0))
+    if counts_b is not None:
+        counts_b = np.asarray(counts_b, dtype=np.int64)
+        assert counts_a.shape == counts_b.shape
+        score -= f_score(counts_b.sum(0))
+
+    statistics = _resample(_bootstrap_statistics,
+                           counts_a,
+                           counts_b,
+                           num_samples,
+                           seed,
+                           n_jobs,
+                           batch_size)
+    lower, upper = np.percentile(statistics, [100 * alpha / 2,
+                                              100 * (1 - alpha / 2)])
+
+    return float(score), float(lower), float(upper)
+
+
+def sigf_evaluation_output(gold_bio, pred_bio, out_path, exact=True):
+    """
+    Produce an output file with the output format for sigf.
+
+    https://nlpado.de/~sebastian/software/sigf.shtml
+    Sigf takes a triple of three numbers for each document and a given
+    system: (TP, # predicted, # gold)
+
+    The same test can be run in-process using document_counts and
+    approximate_randomization.
+
+    Parameters
+    ==========
+    gold_bio : list of list
+        A list of list of BIO tags
+    pred_bio : list of list
+        A list of list of BIO tags
+    out_path : str
+        The path to write the sigf output to.
+
+    """
+    counts = document_counts(gold_bio, pred_bio, exact)
+    np.savetxt(out_path, counts, fmt="%d")
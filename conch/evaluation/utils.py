@@ -2,8 +2,11 @@
 import regex as re
 import numpy as np
 
-from sklearn.metrics import precision_recall_fscore_support
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from conch.corpus import Corpus
+from conch.preprocessing.conll import open_file
 
 # Regex used to convert BIO sequences to indices.
 BIO_FINDER = re.compile(r"BI*")
@@ -21,17 +24,255 @@ def bio_to_index(bio_tags):
     return tags
 
 
+def bio_to_spans(bio_sent, label_codes):
+    """
+    Convert a single sequence of bio tags to an integer array of chunks.
+
+    Parameters
+    ==========
+    bio_sent : list of string
+        A list of BIO tags.
+    label_codes : dict
+        A dictionary mapping from labels to integer codes. Labels which are
+        not in the dictionary are added to it.
+
+    Returns
+    =======
+    spans : np.array
+        An array of shape (chunks, 3), containing the begin, end and label
+        code of each chunk, sorted by begin.
+
+    """
+    no_labels = "".join([x.split("-")[0] for x in bio_sent])
+    spans = []
+    for x in BIO_FINDER.finditer(no_labels):
+        label = bio_sent[x.start()].split("-")[1]
+        spans.append((x.start(),
+                      x.end(),
+                      label_codes.setdefault(label, len(label_codes))))
+
+    return np.array(spans, dtype=np.int64).reshape(-1, 3)
+
+
+def chunk_spans(bio):
+    """
+    Find the chunks of a set of documents.
+
+    Parameters
+    ==========
+    bio : list of lists of strings or Corpus
+        The BIO strings of the documents.
+
+    Returns
+    =======
+    documents : np.array
+        The position of the document of each chunk.
+    spans : np.array
+        An array of shape (chunks, 2) with the begin and end of each chunk,
+        relative to its document.
+    labels : np.array
+        The label of each chunk.
+    lengths : np.array
+        The length of each document.
+
+    """
+    if isinstance(bio, Corpus):
+        documents, begin, end, tags = bio.chunks()
+        labels = np.array([x.split("-")[1] if "-" in x else x
+                           for x in bio.tags] + [""])
+        return (documents,
+                np.stack([begin, end], 1),
+                labels[tags],
+                bio.lengths())
+
+    label_codes = {}
+    spans = [bio_to_spans(x, label_codes) for x in bio]
+    documents = np.repeat(np.arange(len(spans)), [len(x) for x in spans])
+    spans = np.concatenate(spans + [np.zeros((0, 3), dtype=np.int64)])
+    labels = np.array(sorted(label_codes, key=label_codes.get) + [""])
+
+    return (documents,
+            spans[:, :2],
+            labels[spans[:, 2]],
+            np.array([len(x) for x in bio], dtype=np.int64))
+
+
+def align_chunks(gold_bio, pred_bio):
+    """
+    Put the chunks of two sets of documents on a single axis.
+
+    Each document is shifted to its own range of positions, so that chunks
+    can be compared across all documents at once. A gap is left between
+    documents, so chunks from different documents never touch. Only
+    documents which are in both sets are kept.
+
+    Parameters
+    ==========
+    gold_bio : list of lists of strings or Corpus
+        The BIO strings of the gold standard data.
+    pred_bio : list of lists of strings or Corpus
+        The BIO strings of the predicted data.
+
+    Returns
+    =======
+    gold : np.array
+        An array of shape (chunks, 2) of the gold spans, sorted by begin.
+    gold_labels : np.array
+        The label of each gold chunk.
+    pred : np.array
+        An array of shape (chunks, 2) of the predicted spans.
+    shift : np.array
+        The position of the start of each document on the axis.
+
+    """
+    gold_docs, gold, gold_labels, gold_lengths = chunk_spans(gold_bio)
+    pred_docs, pred, _, pred_lengths = chunk_spans(pred_bio)
+
+    num = min(len(gold_lengths), len(pred_lengths))
+    keep = gold_docs < num
+    gold_docs, gold, gold_labels = (gold_docs[keep],
+                                    gold[keep],
+                                    gold_labels[keep])
+    keep = pred_docs < num
+    pred_docs, pred = pred_docs[keep], pred[keep]
+
+    lengths = np.maximum(gold_lengths[:num], pred_lengths[:num]) + 1
+    shift = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+
+    return (gold + shift[gold_docs, None],
+            gold_labels,
+            pred + shift[pred_docs, None],
+            shift)
+
+
+def overlaps(spans, other):
+    """
+    Find the spans of other which overlap with each span.
+
+    Both arrays must be sorted by begin, and the spans within each array
+    must not overlap, so the spans which overlap with a span form a
+    contiguous range.
+
+    Parameters
+    ==========
+    spans : np.array
+        An array of shape (n, 2) of begin and end positions.
+    other : np.array
+        An array of shape (m, 2) of begin and end positions.
+
+    Returns
+    =======
+    num : np.array
+        The number of spans of other which overlap with each span.
+    first : np.array
+        The index of the first overlapping span of other for each span.
+
+    """
+    first = np.searchsorted(other[:, 1], spans[:, 0], "right")
+    num = np.searchsorted(other[:, 0], spans[:, 1], "left") - first
+
+    return num, first
+
+
+def unique_rows(matrix):
+    """
+    Find the unique rows of a matrix.
+
+    Parameters
+    ==========
+    matrix : np.array
+        A 2D matrix.
+
+    Returns
+    =======
+    index : np.array
+        The index of the first occurrence of each unique row.
+    inverse : np.array
+        For each row in the matrix, the position of its row in index.
+
+    """
+    matrix = np.ascontiguousarray(matrix)
+    # View each row as a single opaque item, so rows can be compared as
+    # a whole.
+    width = matrix.dtype.itemsize * matrix.shape[1]
+    rows = matrix.view(np.dtype((np.void, width)))[:, 0]
+    _, index, inverse = np.unique(rows,
+                                  return_index=True,
+                                  return_inverse=True)
+
+    return index, inverse.ravel()
+
+
+def num_batches(num, batch_size):
+    """Calculate the number of batches needed for num items."""
+    return (num + batch_size - 1) // batch_size
+
+
+def report_skipped(skipped, num):
+    """Print the number of zero vectors which were not searched."""
+    print("Skipped search for {} zero vectors out of {}, saved "
+          "{:.3f} of the search".format(skipped, num, skipped / max(num, 1)))
+
+
+def map_batches(function, num, batch_size, n_jobs=1, start=0):
+    """
+    Apply a function to consecutive batches of items.
+
+    Parameters
+    ==========
+    function : function
+        A function which takes the begin and end index of a batch.
+    num : int
+        The number of items.
+    batch_size : int
+        The batch size to use.
+    n_jobs : int, optional, default 1
+        The number of threads to use. If this is larger than 1, batches are
+        processed in a thread pool, with at most 2 * n_jobs batches in
+        flight at the same time.
+    start : int, optional, default 0
+        The first item, e.g. to resume a loop after the items before it.
+
+    Returns
+    =======
+    results : generator
+        The result of the function for each batch, in the order of the
+        batches.
+
+    """
+    ranges = [(x, min(x + batch_size, num))
+              for x in range(start, num, batch_size)]
+
+    if n_jobs == 1:
+        for begin, end in ranges:
+            yield function(begin, end)
+        return
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = deque()
+        for begin, end in ranges:
+            futures.append(executor.submit(function, begin, end))
+            # Only wait for a batch when enough batches are queued, to
+            # bound the memory taken by finished batches.
+            if len(futures) >= 2 * n_jobs:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
 def evaluate_k(true, pred, average='micro'):
     """
     Evaluate a predicted vector of k nearest neighbors for each value of k.
 
     Parameters
     ==========
-    true : list of string
+    true : list of string or np.array
         The true labels
-    pred : lists of lists
+    pred : lists of lists or np.array
         Each sublist contains k strings, which are the k nearest neighbors,
-        ordered by their similarity.
+        ordered by their similarity. Can also be an integer array of shape
+        (items, k) of label codes, e.g. as loaded with knn.load_knn, in
+        which case true must also contain label codes.
     average : string or None, optional, default 'weighted'
         The averaging to use in the scoring function.
 
@@ -41,9 +282,17 @@ def evaluate_k(true, pred, average='micro'):
         An F-score for each class for each value of k.
 
     """
+    # sklearn is slow to import, and only needed here.
+    from sklearn.metrics import precision_recall_fscore_support
+
+    if isinstance(pred, np.ndarray):
+        votes = _majority_votes(true, pred)
+    else:
+        votes = ([Counter(p[:x]).most_common(1)[0][0] for p in pred]
+                 for x in range(1, len(pred[0])))
+
     s = []
-    for x in range(1, len(pred[0])):
-        p = [Counter(p[:x]).most_common(1)[0][0] for p in pred]
+    for p in votes:
         score = precision_recall_fscore_support(true, p, average=average)
         score = np.array(score).tolist()
         s.append(score)
@@ -51,10 +300,33 @@ def evaluate_k(true, pred, average='micro'):
     return s
 
 
-def to_conll(pred, gold, outputpath):
+def _majority_votes(true, pred):
+    """
+    Compute the majority vote of the first x neighbors for each x.
+
+    Ties are broken in favor of the label which occurs first, like
+    Counter.most_common does.
+    """
+    num, k = pred.shape
+    num_labels = int(max(pred.max(), np.max(true))) + 1
+    rows = np.arange(num)
+
+    counts = np.zeros((num, num_labels), dtype=np.int64)
+    first = np.full((num, num_labels), k, dtype=np.int64)
+
+    for x in range(1, k):
+        column = pred[:, x-1]
+        counts[rows, column] += 1
+        first[rows, column] = np.minimum(first[rows, column], x-1)
+        yield np.argmax(counts * (k + 1) - first, axis=1)
+
+
+def to_conll(pred, gold, outputpath, buffer_size=10000):
     """Convert pred and gold BIO sequences to .conll format."""
     assert(len(pred) == len(gold))
 
-    with open(outputpath, 'w') as f:
-        for x, y in zip(gold, pred):
-            f.write("_ _ {0} {1}\n".format(x, y))
+    with open_file(outputpath, 'w') as f:
+        for x in range(0, len(gold), buffer_size):
+            f.write("".join("_ _ {0} {1}\n".format(g, p)
+                            for g, p in zip(gold[x:x+buffer_size],
+                                            pred[x:x+buffer_size])))
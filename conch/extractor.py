@@ -0,0 +1,233 @@
+"""Low-latency concept extraction from single documents."""
+import threading
+import numpy as np
+import regex as re
+
+from conch.conch import reciprocal
+from conch.label_table import LabelTable
+
+bio_regex = re.compile(r"BI*")
+
+
+class ConceptExtractor(object):
+    """
+    Long-lived concept extractor for one document at a time.
+
+    The extractor composes and labels the phrases of a document like
+    compose followed by eval_extrinsic, but without building a Reach
+    instance, a progress bar or a dictionary of labels per call. All
+    lookups which do not depend on the document are done once, and each
+    thread reuses its own scratch buffers, which only grow if a document
+    does not fit in them. An extractor can be shared between threads.
+
+    Parameters
+    ==========
+    embeddings : Reach
+        The word embeddings.
+    concepts : Reach
+        The concept vectors.
+    concept_labels : dict or LabelTable
+        A mapping from concept names to labels.
+    window : int, optional, default 0
+        The window size to use.
+    context_function : function, optional, default reciprocal
+        The function which is used to weigh the contexts.
+    use_focus : bool, optional, default True
+        Whether to vectorize the focus word.
+    norm : bool, optional, default False
+        Whether to use the unit vectors to compose.
+    max_tokens : int, optional, default 1024
+        The initial number of tokens of the scratch buffers.
+    max_phrases : int, optional, default 256
+        The initial number of phrases of the scratch buffers.
+    dtype : numpy dtype, optional, default np.float32
+        The dtype in which the phrases are composed and searched.
+
+    Attributes
+    ==========
+    labels : list of str
+        The label of each label code, including "np".
+
+    """
+
+    def __init__(self,
+                 embeddings,
+                 concepts,
+                 concept_labels,
+                 window=0,
+                 context_function=reciprocal,
+                 use_focus=True,
+                 norm=False,
+                 max_tokens=1024,
+                 max_phrases=256,
+                 dtype=np.float32):
+        """Prepare the embeddings and concepts."""
+        self.window = window
+        self.context_function = context_function
+        self.use_focus = use_focus
+        self.dtype = dtype
+        self.max_tokens = max_tokens
+        self.max_phrases = max_phrases
+
+        self._items = embeddings.items
+        self._vectors = (embeddings.norm_vectors if norm
+                         else embeddings.vectors)
+        # Like Reach, OOV words get the unnormalized vector of UNK.
+        self._unk = None
+        if embeddings.unk_index is not None:
+            self._unk = embeddings.vectors[embeddings.unk_index]
+
+        names = [concepts.indices[x] for x in range(len(concepts.indices))]
+        if isinstance(concept_labels, LabelTable):
+            codes = concept_labels.lookup(names)
+            if np.any(codes < 0):
+                raise KeyError(names[np.flatnonzero(codes < 0)[0]])
+            names_labels = [concept_labels.labels[x] for x in codes]
+        else:
+            names_labels = [concept_labels[x] for x in names]
+
+        self.labels = sorted(set(names_labels) | {"np"})
+        codes = {label: idx for idx, label in enumerate(self.labels)}
+        self._codes = np.array([codes[x] for x in names_labels],
+                               dtype=np.int64)
+        self._np = codes["np"]
+        self._concepts = np.asarray(concepts.norm_vectors, dtype=dtype)
+
+        self._local = threading.local()
+
+    def extract(self, tokens, bio):
+        """
+        Label the chunks of a single document.
+
+        Parameters
+        ==========
+        tokens : list of str
+            The tokens of the document.
+        bio : list of str
+            The BIO tags of the chunks of the document.
+
+        Returns
+        =======
+        new_bio : list of str
+            The BIO tags of the labelled chunks. Chunks with the label "np"
+            are not inserted, like in eval_extrinsic.
+
+        """
+        new_bio = ["O"] * len(bio)
+        for begin, end, label in self.label(tokens, bio):
+            if label == "np":
+                continue
+            new_bio[begin] = "B-{}".format(label)
+            for idx in range(begin + 1, end):
+                new_bio[idx] = "I-{}".format(label)
+
+        return new_bio
+
+    def label(self, tokens, bio):
+        """
+        Get the label of each chunk of a single document.
+
+        Parameters
+        ==========
+        tokens : list of str
+            The tokens of the document.
+        bio : list of str
+            The BIO tags of the chunks of the document.
+
+        Returns
+        =======
+        chunks : list of tuples
+            A (begin, end, label) tuple for each chunk.
+
+        """
+        # The same tokenization as iter_phrases.
+        txt = " ".join(tokens).lower().split()
+        spans = [t.span() for t in bio_regex.finditer(
+            "".join([x.split("-")[0] for x in bio]))]
+        if not spans:
+            return []
+
+        token_vectors, parts, phrases, scores = self._buffers(len(txt),
+                                                              len(spans))
+        token_vectors = token_vectors[:len(txt)]
+        self._vectorize(txt, token_vectors)
+
+        phrases = phrases[:len(spans)]
+        for idx, (begin, end) in enumerate(spans):
+            self._compose(token_vectors, begin, end, parts, phrases[idx])
+
+        norm = np.linalg.norm(phrases, axis=1)
+        nonzero = norm > 0
+        phrases[nonzero] /= norm[nonzero, None]
+
+        scores = scores[:len(spans)]
+        np.dot(phrases, self._concepts.T, out=scores)
+        codes = self._codes[scores.argmax(1)]
+        codes[~nonzero] = self._np
+
+        return [(begin, end, self.labels[code])
+                for (begin, end), code in zip(spans, codes.tolist())]
+
+    def _buffers(self, num_tokens, num_phrases):
+        """Get the scratch buffers of this thread, grown if needed."""
+        local = self._local
+        if getattr(local, "token_vectors", None) is None:
+            local.token_vectors = np.empty((self.max_tokens,
+                                            self._vectors.shape[1]),
+                                           dtype=self._vectors.dtype)
+            local.parts = np.empty((3, self._concepts.shape[1]),
+                                   dtype=self.dtype)
+            local.phrases = np.empty((self.max_phrases,
+                                      self._concepts.shape[1]),
+                                     dtype=self.dtype)
+            local.scores = np.empty((self.max_phrases,
+                                     len(self._concepts)),
+                                    dtype=self._concepts.dtype)
+        if num_tokens > len(local.token_vectors):
+            local.token_vectors = np.empty((2 * num_tokens,
+                                            self._vectors.shape[1]),
+                                           dtype=self._vectors.dtype)
+        if num_phrases > len(local.phrases):
+            local.phrases = np.empty((2 * num_phrases,
+                                      self._concepts.shape[1]),
+                                     dtype=self.dtype)
+            local.scores = np.empty((2 * num_phrases,
+                                     len(self._concepts)),
+                                    dtype=self._concepts.dtype)
+
+        return (local.token_vectors,
+                local.parts,
+                local.phrases,
+                local.scores)
+
+    def _vectorize(self, txt, out):
+        """Write the vector of each token to out."""
+        indices = np.array([self._items.get(x, -1) for x in txt],
+                           dtype=np.int64)
+        np.take(self._vectors, indices, axis=0, out=out)
+        oov = indices < 0
+        if np.any(oov):
+            if self._unk is None:
+                word = txt[np.flatnonzero(oov)[0]]
+                raise ValueError("'{}' is not present in the vector "
+                                 "space.".format(word))
+            out[oov] = self._unk
+
+    def _compose(self, token_vectors, begin, end, parts, out):
+        """Compose a single phrase like _vectorize_context."""
+        dtype, window = self.dtype, self.window
+        parts[:] = 0
+        focus = token_vectors[begin:end]
+        if self.use_focus and len(focus):
+            parts[1] = np.mean(focus.astype(dtype, copy=False), axis=0)
+        if window > 0:
+            left = token_vectors[max(begin - window, 0):begin][::-1]
+            right = token_vectors[end:end + window]
+            if len(left):
+                left = self.context_function(left.astype(dtype, copy=False))
+                parts[0] = np.mean(left, axis=0)
+            if len(right):
+                right = self.context_function(right.astype(dtype,
+                                                           copy=False))
+                parts[2] = np.mean(right, axis=0)
+        np.mean(parts, axis=0, out=out)
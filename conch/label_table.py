@@ -0,0 +1,140 @@
+"""A memory-mapped table from concept identifiers to labels."""
+import json
+import os
+import numpy as np
+
+from conch.embeddings import _dump_json
+from conch.evaluation.knn import code_dtype
+
+
+def save_label_table(keys, codes, labels, path):
+    """
+    Save a mapping from keys to labels as a label table.
+
+    The keys are stored as a sorted array of byte strings, and the labels
+    as integer codes into a list of labels. If a key occurs more than once,
+    its last label is kept, like when updating a dictionary.
+
+    Parameters
+    ==========
+    keys : list of str or np.array
+        The keys, e.g. CUIs or concept names. Byte strings are assumed to
+        be UTF-8.
+    codes : list of int or np.array
+        The label code of each key.
+    labels : list of str
+        The label of each label code.
+    path : str
+        The directory of the table. It is created if it does not exist.
+
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    keys = np.asarray(keys)
+    if keys.dtype.kind != "S":
+        keys = np.char.encode(keys.astype(str), "utf-8")
+    codes = np.asarray(codes, dtype=code_dtype(len(labels)))
+    assert len(keys) == len(codes)
+
+    # A stable sort keeps duplicate keys in order of appearance, so the
+    # last of each run of equal keys is the last occurrence.
+    order = np.argsort(keys, kind="stable")
+    keys, codes = keys[order], codes[order]
+    last = np.ones(len(keys), dtype=bool)
+    last[:-1] = keys[1:] != keys[:-1]
+
+    np.save(os.path.join(path, "keys.npy"), keys[last])
+    np.save(os.path.join(path, "codes.npy"), codes[last])
+    # The labels are written last, so an incomplete table can not be opened.
+    _dump_json(list(labels), os.path.join(path, "labels.json"))
+
+
+class LabelTable(object):
+    """
+    Memory-mapped mapping from keys to labels.
+
+    A label table can be used in place of the dictionaries from concept
+    names to labels, e.g. in create_concepts and eval_extrinsic, but does
+    not need to be loaded into memory. Single keys are looked up with a
+    binary search, and many keys at once with lookup.
+
+    Parameters
+    ==========
+    path : str
+        The directory of a table written by save_label_table.
+
+    Attributes
+    ==========
+    labels : list of str
+        The label of each label code.
+    keys : np.array
+        The sorted keys, as byte strings.
+    codes : np.array
+        The label code of each key.
+
+    """
+
+    def __init__(self, path):
+        """Open a label table."""
+        self.path = path
+        self.labels = json.load(open(os.path.join(path, "labels.json")))
+        self.keys = np.load(os.path.join(path, "keys.npy"), mmap_mode="r")
+        self.codes = np.load(os.path.join(path, "codes.npy"), mmap_mode="r")
+
+    def __len__(self):
+        """Get the number of keys."""
+        return len(self.keys)
+
+    def __contains__(self, key):
+        """Check whether a key is in the table."""
+        return self._code(key) >= 0
+
+    def __getitem__(self, key):
+        """Get the label of a key."""
+        code = self._code(key)
+        if code < 0:
+            raise KeyError(key)
+        return self.labels[code]
+
+    def get(self, key, default=None):
+        """Get the label of a key, or a default if it is not in the table."""
+        code = self._code(key)
+        if code < 0:
+            return default
+        return self.labels[code]
+
+    def _code(self, key):
+        """Get the label code of a single key, or -1."""
+        key = key.encode("utf-8")
+        idx = np.searchsorted(self.keys, key)
+        if idx < len(self.keys) and self.keys[idx] == key:
+            return int(self.codes[idx])
+        return -1
+
+    def lookup(self, keys):
+        """
+        Get the label codes of many keys at once.
+
+        Parameters
+        ==========
+        keys : list of str
+            The keys to look up.
+
+        Returns
+        =======
+        codes : np.array
+            The label code of each key, or -1 if it is not in the table.
+
+        """
+        keys = np.char.encode(np.asarray(keys, dtype=str), "utf-8")
+        codes = np.full(len(keys), -1, dtype=np.int32)
+        if not len(self.keys) or not len(keys):
+            return codes
+
+        idx = np.searchsorted(self.keys, keys)
+        found = idx < len(self.keys)
+        found[found] = self.keys[idx[found]] == keys[found]
+        codes[found] = self.codes[idx[found]]
+
+        return codes
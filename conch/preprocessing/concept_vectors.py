@@ -1,25 +1,72 @@
 """Create concept vectors."""
-import numpy as np
+import hashlib
 import json
+import os
+import numpy as np
 
 from tqdm import tqdm
 from reach import Reach
+from conch.label_table import LabelTable, save_label_table
+from conch.embeddings import (load_pruned,
+                              corpus_vocabulary,
+                              reach_from_arrays,
+                              _dump_json)
 
 
 def create_concepts(concepts,
                     embeddings,
                     include_np=True,
-                    labels=None):
-    """Create concepts by summing over descriptions in embedding spaces."""
+                    labels=None,
+                    dtype=np.float32,
+                    cache_dir=None):
+    """
+    Create concepts by summing over descriptions in embedding spaces.
+
+    Parameters
+    ==========
+    concepts : dict
+        A dictionary mapping from concept names to lists of descriptions.
+    embeddings : Reach
+        The word embeddings.
+    include_np : bool, optional, default True
+        Whether to include concepts with the label "np".
+    labels : dict or LabelTable, optional, default None
+        A dictionary mapping from concept names to labels. If this is not
+        None, concepts without a label are skipped.
+    dtype : numpy dtype, optional, default np.float32
+        The dtype of the concept vectors.
+    cache_dir : str, optional, default None
+        If this is not None, the concept space is cached in this directory,
+        keyed by a fingerprint of all inputs. Later calls with the same
+        inputs memory-map the cached space instead of recomputing it.
+
+    Returns
+    =======
+    concepts : Reach
+        A reach instance containing the concepts and their vectors.
+
+    """
+    if cache_dir is not None:
+        prefix = os.path.join(cache_dir,
+                              "concepts_{}".format(
+                                  _fingerprint(concepts,
+                                               embeddings,
+                                               include_np,
+                                               labels,
+                                               dtype)))
+        if os.path.exists("{}_names.json".format(prefix)):
+            return load_cache(prefix)
+
     # Gold standard labels for concepts:
     concept_names = []
     vectors = []
 
     for name, descriptions in tqdm(list(concepts.items())):
 
+        label = None
         if labels is not None:
             try:
-                label = sty[name]
+                label = labels[name]
             except KeyError:
                 continue
 
@@ -34,6 +81,7 @@ def create_concepts(concepts,
                 desc = desc.lower().split()
                 # desc = [x for x in desc if x not in STOP_WORDS]
                 vec = embeddings.vectorize(desc, remove_oov=True)
+                vec = vec.astype(dtype, copy=False)
                 if not np.any(vec):
                     continue
                 concept.append(np.mean(vec, axis=0))
@@ -46,20 +94,80 @@ def create_concepts(concepts,
         concept_names.append(name)
         vectors.append(np.array(concept).mean(axis=0))
 
-    r = Reach(np.array(vectors), concept_names)
+    r = Reach(np.array(vectors, dtype=dtype), concept_names)
+
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        save_cache(r, prefix)
 
     return r
 
 
+def _fingerprint(concepts, embeddings, include_np, labels, dtype):
+    """
+    Identify the inputs of create_concepts.
+
+    Only the vectors of the words in the descriptions are hashed, because
+    the other vectors do not change the concepts.
+    """
+    words = sorted(w for w in corpus_vocabulary([], concepts)
+                   if w in embeddings.items)
+    rows = np.asarray(embeddings.vectors[[embeddings.items[w]
+                                          for w in words]])
+
+    h = hashlib.sha1()
+    h.update(json.dumps([list(concepts.items()),
+                         include_np,
+                         None if labels is None
+                         else [labels.get(k) for k in concepts],
+                         np.dtype(dtype).str,
+                         words]).encode("utf-8"))
+    h.update(rows.dtype.str.encode("utf-8"))
+    h.update(np.ascontiguousarray(rows).tobytes())
+
+    return h.hexdigest()
+
+
+def save_cache(r, prefix):
+    """
+    Save a concept space in the cache format of conch.embeddings.
+
+    The names are written last, so an interrupted save is never seen as a
+    valid cache.
+    """
+    for suffix, vectors in (("vectors", r.vectors),
+                            ("norm", r.norm_vectors)):
+        tmp = "{}_{}.{}.tmp.npy".format(prefix, suffix, os.getpid())
+        np.save(tmp, vectors)
+        os.replace(tmp, "{}_{}.npy".format(prefix, suffix))
+    names = [r.indices[x] for x in range(len(r.indices))]
+    _dump_json(names, "{}_names.json".format(prefix))
+
+
+def load_cache(prefix):
+    """Load a cached concept space, with memory-mapped vectors."""
+    names = json.load(open("{}_names.json".format(prefix)))
+    vectors = np.load("{}_vectors.npy".format(prefix), mmap_mode="r")
+    norm_vectors = np.load("{}_norm.npy".format(prefix), mmap_mode="r")
+
+    return reach_from_arrays(vectors, norm_vectors, names)
+
+
 if __name__ == "__main__":
 
     path_to_embeddings = ""
-    r_1 = Reach.load(path_to_embeddings, unk_word="UNK")
-
     concepts = json.load(open("data/all_concepts.json"))
-    sty = json.load(open("data/concept_label.json"))
+    r_1 = load_pruned(path_to_embeddings,
+                      corpus_vocabulary([], concepts),
+                      unk_word="UNK")
+
+    sty = LabelTable("data/concept_label")
     r = create_concepts(concepts, r_1, include_np=True, labels=sty)
     r.save_fast_format("data/concept_vectors")
 
-    name2label = {k: sty[k.split("-")[0]] for k in r.items()}
-    json.dump(name2label, open("data/names2label.json", 'w'))
+    names = [r.indices[x] for x in range(len(r.indices))]
+    save_label_table(names,
+                     sty.lookup([x.split("-")[0] for x in names]),
+                     sty.labels,
+                     "data/names2label")
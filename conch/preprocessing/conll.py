@@ -0,0 +1,94 @@
+"""Stream documents in CoNLL and Cubner format."""
+import gzip
+
+from itertools import islice
+
+
+def open_file(path, mode='r'):
+    """Open a text file, which is read or written as gzip if it ends in .gz."""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + 't', encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def iter_documents(path, separator=None):
+    """
+    Read documents from a file with one token per line.
+
+    Documents are separated by empty lines. The token is the first column
+    of a line, and the tag is the last column. Lines with a single column
+    are skipped. Only one document is held in memory at a time.
+
+    Parameters
+    ==========
+    path : str
+        The path to the file. If it ends in .gz, it is read as gzip.
+    separator : str, optional, default None
+        The column separator. If this is None, columns are separated by
+        any whitespace.
+
+    Returns
+    =======
+    documents : generator
+        A generator of (tokens, bio) tuples.
+
+    """
+    tokens, tags = [], []
+    with open_file(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                if tokens:
+                    yield tokens, tags
+                    tokens, tags = [], []
+                continue
+            columns = line.split(separator)
+            if len(columns) < 2:
+                continue
+            tokens.append(columns[0])
+            tags.append(columns[-1])
+
+    if tokens:
+        yield tokens, tags
+
+
+def write_documents(documents, path, separator=" ", buffer_size=1000):
+    """
+    Write documents to a file with one token per line.
+
+    Parameters
+    ==========
+    documents : iterable
+        An iterable of documents, each of which is a tuple of columns of
+        the same length, e.g. (tokens, bio). It is consumed lazily.
+    path : str
+        The path to the file. If it ends in .gz, it is written as gzip.
+    separator : str, optional, default " "
+        The column separator.
+    buffer_size : int, optional, default 1000
+        The number of documents which are joined before being written.
+
+    """
+    documents = iter(documents)
+    with open_file(path, 'w') as f:
+        while True:
+            batch = list(islice(documents, buffer_size))
+            if not batch:
+                break
+            f.write("".join(_format_document(x, separator) for x in batch))
+
+
+def _format_document(columns, separator):
+    """Format a document as lines of columns, followed by an empty line."""
+    rows = zip(*[[str(x).strip() for x in column] for column in columns])
+    return "".join("{}\n".format(separator.join(row)) for row in rows) + "\n"
+
+
+def read_conll(path):
+    """Read (tokens, bio) documents from a whitespace separated file."""
+    return iter_documents(path)
+
+
+def write_conll(documents, path, buffer_size=1000):
+    """Write (tokens, bio) documents to a space separated file."""
+    write_documents(documents, path, " ", buffer_size)
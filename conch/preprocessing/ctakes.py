@@ -1,12 +1,13 @@
 """Extract sentence and NP chunks from documents parsed with ctakes."""
-import json
 import os
 
 from collections import OrderedDict, Counter
-from lxml import etree
 from io import open
 from glob import glob
 
+from conch.corpus import save_corpus
+from conch.preprocessing.ingest import ingest, read_bytes
+
 NS = {'refsem': 'http:///org/apache/ctakes/typesystem/type/refsem.ecore',
       'cas': 'http:///uima/cas.ecore',
       'textspan': 'http:///org/apache/ctakes/typesystem/type/textspan.ecore',
@@ -95,7 +96,7 @@ def get_chunks(ns, root, text, sentences):
     return sents, bios
 
 
-def process(paths):
+def process(paths, concurrency=None):
     """
     Process a set of ctakes parsed documents.
 
@@ -103,6 +104,10 @@ def process(paths):
     ==========
     paths : list of string
         A list of paths to the XML files being parsed.
+    concurrency : int, optional, default None
+        If this is not None, files are read concurrently with at most this
+        many reads in flight, and parsed in a process pool. See
+        ingest.ingest.
 
     Returns
     =======
@@ -113,37 +118,59 @@ def process(paths):
         text.
 
     """
-    chunks = {}
+    paths = list(paths)
+    names = [os.path.splitext(os.path.split(path)[-1])[0] for path in paths]
+
+    if concurrency is None:
+        parsed = [parse_xmi(read_bytes(path)) for path in paths]
+    else:
+        parsed = ingest(paths, read_bytes, parse_xmi, concurrency)
+
+    return dict(zip(names, parsed))
+
+
+def parse_xmi(data):
+    """
+    Extract the tokens and NP chunks from the contents of a ctakes file.
 
-    for path in paths:
+    Parameters
+    ==========
+    data : bytes
+        The contents of an XML file.
+
+    Returns
+    =======
+    chunks : tuple
+        A tuple of lists, the first of which is the raw text, and the
+        second of which is the BIO string of said text.
 
-        name = os.path.splitext(os.path.split(path)[-1])[0]
-        root = etree.parse(open(path)).getroot()
+    """
+    from lxml import etree
 
-        for cas in root.findall('cas:Sofa', NS):
-            for attr in cas.attrib:
-                if attr == 'sofaString':
-                    content = cas.get(attr)
+    root = etree.fromstring(data)
 
-        sentences = get_sentences(content)
-        chunks[name] = get_chunks(NS, root, content, sentences=sentences)
+    for cas in root.findall('cas:Sofa', NS):
+        for attr in cas.attrib:
+            if attr == 'sofaString':
+                content = cas.get(attr)
 
-    return chunks
+    sentences = get_sentences(content)
+    return get_chunks(NS, root, content, sentences=sentences)
 
 
 if __name__ == "__main__":
 
     base = ""
     g = glob(os.path.join(base, "beth/*.xml"))
-    beth = process(g)
+    beth = process(g, concurrency=16)
     g = glob(os.path.join(base, "partners/*.xml"))
-    partners = process(g)
+    partners = process(g, concurrency=16)
 
-    json.dump(beth, open("data/beth_uima.json", 'w'))
-    json.dump(partners, open("data/partners_uima.json", 'w'))
+    save_corpus(beth, "data/beth_uima")
+    save_corpus(partners, "data/partners_uima")
     beth.update(partners)
-    json.dump(beth, open("data/train_uima.json", 'w'))
+    save_corpus(beth, "data/train_uima")
 
     g = glob(os.path.join(base, "test/*.xml"))
-    result = process(g)
-    json.dump(result, open("data/test_uima.json", 'w'))
+    result = process(g, concurrency=16)
+    save_corpus(result, "data/test_uima")
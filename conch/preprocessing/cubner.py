@@ -1,49 +1,61 @@
 """Create text files for Cubner."""
 import os
 from glob import iglob
+from itertools import islice
+
+from conch.preprocessing.conll import (iter_documents,
+                                      open_file,
+                                      write_documents)
 
 
 def read_cubner(pathtofile):
     """Read cubner output format."""
     words, tags = [], []
-    count = 0
-    index = 0
-
-    for line in open(pathtofile):
+    for txt, bio in iter_cubner(pathtofile):
+        words.extend(txt)
+        tags.extend(bio)
 
-        line = line.strip()
+    return words, tags
 
-        if line:
-            try:
-                w, np, t = line.split("\t")
-            except ValueError:
-                count += 1
-                continue
-            words.append(w)
-            tags.append(t)
-            index += 1
 
-    return words, tags
+def iter_cubner(pathtofile):
+    """Read cubner output format, one (tokens, bio) document at a time."""
+    return iter_documents(pathtofile, "\t")
 
 
 def write_cubner(data, pathtofile):
-    """Write cubner output format."""
-    f = open(pathtofile, 'w')
-    for txt, bio in list(zip(*sorted(data.items())))[1]:
-        for w, tag in zip(txt, bio):
-            w = w.strip()
-            f.write("{}\t{}\n".format(w, tag))
-        f.write("\n")
+    """
+    Write cubner output format.
+
+    Parameters
+    ==========
+    data : dict or iterable
+        A dictionary mapping from document keys to (tokens, bio) tuples,
+        which are written in order of their keys, or an iterable of
+        (tokens, bio) tuples, which is consumed lazily.
+    pathtofile : str
+        The path to write to. If it ends in .gz, it is written as gzip.
+
+    """
+    documents = data
+    if isinstance(data, dict):
+        documents = (data[k] for k in sorted(data))
+    write_documents(documents, pathtofile, "\t")
 
 
-def write_file(filename, paths):
+def write_file(filename, paths, buffer_size=1000):
     """Write all documents to a single file."""
-    f = open(filename, 'w')
-    for path in sorted(paths):
-        for line in open(path):
-            # Because not all lines end with newlines.
-            f.write("{} ".format(line.strip()))
-        f.write("\n")
+    with open_file(filename, 'w') as f:
+        for path in sorted(paths):
+            with open_file(path) as g:
+                while True:
+                    lines = list(islice(g, buffer_size))
+                    if not lines:
+                        break
+                    # Because not all lines end with newlines.
+                    f.write("".join("{} ".format(line.strip())
+                                    for line in lines))
+            f.write("\n")
 
 
 if __name__ == "__main__":
@@ -1,11 +1,13 @@
 """Extract gold chunks from the i2b2 dataset."""
 import os
-import json
 from itertools import chain, combinations
 from collections import defaultdict
 
 from glob import iglob
 
+from conch.corpus import save_corpus
+from conch.preprocessing.ingest import ingest
+
 
 def _single_overlap(a, b):
     """Check overlap between two chunks."""
@@ -37,8 +39,15 @@ def _check_overlap(chunks):
 
 def extract_chunks(text_path, con_path, remove_overlap=False):
     """Extract chunks from a matching set of .txt and .con files."""
-    con = open(con_path).readlines()
-    text = [x.split() for x in open(text_path).readlines()]
+    return extract_from_lines(open(text_path).readlines(),
+                              open(con_path).readlines(),
+                              remove_overlap,
+                              text_path)
+
+
+def extract_from_lines(text, con, remove_overlap=False, filename=""):
+    """Extract chunks from the lines of a .txt and .con file."""
+    text = [x.split() for x in text]
     bio = [["O"] * len(x) for x in text]
 
     bio_dict = defaultdict(list)
@@ -94,6 +103,52 @@ def extract_chunks(text_path, con_path, remove_overlap=False):
             list(chain.from_iterable(bio)))
 
 
+def read_pair(text_path):
+    """Read the lines of a .txt file and its matching .con file."""
+    without_ext = os.path.splitext(text_path)[0]
+    return (text_path,
+            open(text_path).readlines(),
+            open(without_ext + ".con").readlines())
+
+
+def _extract_pair(pair):
+    """Extract chunks from the output of read_pair."""
+    text_path, text, con = pair
+    return extract_from_lines(text, con, filename=text_path)
+
+
+def process(paths, concurrency=None):
+    """
+    Extract the gold chunks of a set of i2b2 documents.
+
+    Parameters
+    ==========
+    paths : list of string
+        A list of paths to .txt files. The .con files are assumed to be in
+        the same directory.
+    concurrency : int, optional, default None
+        If this is not None, files are read concurrently with at most this
+        many reads in flight, and parsed in a process pool. See
+        ingest.ingest.
+
+    Returns
+    =======
+    chunks : dict
+        A dict of tuples, where the key of the dictionary is the file-name,
+        and the value is a tuple of the tokens and BIO tags of the file.
+
+    """
+    paths = list(paths)
+    keys = [os.path.splitext(os.path.split(x)[-1])[0] for x in paths]
+
+    if concurrency is None:
+        chunks = [_extract_pair(read_pair(x)) for x in paths]
+    else:
+        chunks = ingest(paths, read_pair, _extract_pair, concurrency)
+
+    return dict(zip(keys, chunks))
+
+
 if __name__ == "__main__":
 
     # TODO: these paths are for convenience,
@@ -103,34 +158,14 @@ if __name__ == "__main__":
     partners_path = os.path.join(base_path, "partners/*.txt")
     test_path = os.path.join(base_path, "test/*.txt")
 
-    train = {}
-    test = {}
-    beth = {}
-    partners = {}
-
-    for filename in iglob(beth_path):
-
-        without_ext = os.path.splitext(filename)[0]
-        key = os.path.splitext(os.path.split(filename)[-1])[0]
-        c = extract_chunks(filename, without_ext + ".con")
-        train[key] = c
-        beth[key] = c
-
-    for filename in iglob(partners_path):
-
-        without_ext = os.path.splitext(filename)[0]
-        key = os.path.splitext(os.path.split(filename)[-1])[0]
-        c = extract_chunks(filename, without_ext + ".con")
-        train[key] = c
-        partners[key] = c
-
-    for filename in iglob(test_path):
+    beth = process(iglob(beth_path), concurrency=16)
+    partners = process(iglob(partners_path), concurrency=16)
+    test = process(iglob(test_path), concurrency=16)
 
-        without_ext = os.path.splitext(filename)[0]
-        key = os.path.splitext(os.path.split(filename)[-1])[0]
-        test[key] = extract_chunks(filename, without_ext + ".con")
+    train = dict(beth)
+    train.update(partners)
 
-    json.dump(train, open("data/train_gold.json", 'w'))
-    json.dump(test, open("data/test_gold.json", 'w'))
-    json.dump(beth, open("data/beth_gold.json", 'w'))
-    json.dump(partners, open("data/partners_gold.json", 'w'))
+    save_corpus(train, "data/train_gold")
+    save_corpus(test, "data/test_gold")
+    save_corpus(beth, "data/beth_gold")
+    save_corpus(partners, "data/partners_gold")
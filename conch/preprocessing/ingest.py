@@ -0,0 +1,130 @@
+"""Read and parse many files concurrently."""
+import asyncio
+import os
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def read_bytes(path):
+    """Read the contents of a file as bytes."""
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def ingest(items,
+           read,
+           parse,
+           concurrency=16,
+           num_parsers=None,
+           executor=None,
+           queue_size=None):
+    """
+    Read and parse items, overlapping the reading with the parsing.
+
+    Items are read with at most concurrency reads in flight, and the
+    results are parsed in an executor. Read items wait in a bounded queue
+    until a parser is free, so reading never runs far ahead of parsing.
+
+    Parameters
+    ==========
+    items : list
+        The items to read, e.g. paths.
+    read : function
+        A blocking function which reads a single item, e.g. read_bytes.
+    parse : function
+        A function which parses the output of read. If executor is a
+        process pool, it must be picklable, so defined at module level.
+    concurrency : int, optional, default 16
+        The maximum number of concurrent reads.
+    num_parsers : int, optional, default None
+        The number of items which are parsed at the same time. If this is
+        None, it is the number of CPUs if no executor is given, and the
+        concurrency otherwise. Should match the number of workers of the
+        executor.
+    executor : Executor, optional, default None
+        The executor in which items are parsed. If this is None, a process
+        pool with num_parsers workers is created, and shut down
+        afterwards.
+    queue_size : int, optional, default None
+        The maximum number of read, but unparsed, items. If this is None,
+        it is twice the concurrency.
+
+    Returns
+    =======
+    results : list
+        The parsed items, in the order of items.
+
+    """
+    own_executor = executor is None
+    if num_parsers is None:
+        num_parsers = (os.cpu_count() or 1) if own_executor else concurrency
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=num_parsers)
+    if queue_size is None:
+        queue_size = 2 * concurrency
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as io_executor:
+            return asyncio.run(_ingest(list(items),
+                                       read,
+                                       parse,
+                                       concurrency,
+                                       num_parsers,
+                                       io_executor,
+                                       executor,
+                                       queue_size))
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+
+async def _ingest(items,
+                  read,
+                  parse,
+                  concurrency,
+                  num_parsers,
+                  io_executor,
+                  executor,
+                  queue_size):
+    """Run the readers and parsers."""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    queue = asyncio.Queue(maxsize=queue_size)
+    results = [None] * len(items)
+    errors = []
+
+    async def reader(idx, item):
+        async with semaphore:
+            data = await loop.run_in_executor(io_executor, read, item)
+            # Blocks while the queue is full, which pauses reading, because
+            # the semaphore is only released after the item is queued.
+            await queue.put((idx, data))
+
+    async def parser():
+        while True:
+            idx, data = await queue.get()
+            try:
+                results[idx] = await loop.run_in_executor(executor,
+                                                          parse,
+                                                          data)
+            except Exception as e:
+                # Keep emptying the queue, so readers never block forever.
+                errors.append(e)
+            finally:
+                queue.task_done()
+
+    parsers = [asyncio.ensure_future(parser()) for _ in range(num_parsers)]
+    readers = [asyncio.ensure_future(reader(idx, item))
+               for idx, item in enumerate(items)]
+
+    try:
+        await asyncio.gather(*readers)
+        await queue.join()
+    finally:
+        for task in parsers + readers:
+            task.cancel()
+
+    if errors:
+        raise errors[0]
+
+    return results
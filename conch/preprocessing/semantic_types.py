@@ -1,29 +1,112 @@
 """Create Semantic type identifiers."""
 import json
+import re
+import numpy as np
 
+from conch.label_table import save_label_table
 
-if __name__ == "__main__":
+LABELS = ["np", "problem", "test", "treatment"]
+
+TEST = ['T060', 'T059', 'T034']
+TREATMENT = ['T061', 'T200']
+PROBLEM = ['T020', 'T190', 'T049',
+           'T019', 'T047', 'T050',
+           'T033', 'T037', 'T048',
+           'T191', 'T046', 'T184']
+
+_separator = re.compile(r"[\s,]*")
+
+
+def sty_label(sty):
+    """Get the label of a semantic type."""
+    if sty in PROBLEM:
+        return "problem"
+    elif sty in TEST:
+        return "test"
+    elif sty in TREATMENT:
+        return "treatment"
+    return "np"
+
+
+def iter_json_array(path, buffer_size=1 << 20):
+    """
+    Parse the items of a JSON array one at a time.
+
+    Only a buffer of the file is kept in memory, which grows if a single
+    item does not fit in it. The items must be objects or arrays, because
+    a number at the end of the buffer can not be told apart from a number
+    which continues in the rest of the file.
+
+    Parameters
+    ==========
+    path : str
+        The path to a JSON file which contains a single array.
+    buffer_size : int, optional, default 1 << 20
+        The number of characters to read at a time.
 
-    stys = {x["_id"]: x["concepts"] for x in json.load(open("data/stys.json"))}
+    Returns
+    =======
+    items : generator
+        A generator of the parsed items.
 
-    test = ['T060', 'T059', 'T034']
-    treatment = ['T061', 'T200']
-    problem = ['T020', 'T190', 'T049',
-               'T019', 'T047', 'T050',
-               'T033', 'T037', 'T048',
-               'T191', 'T046', 'T184']
+    """
+    decoder = json.JSONDecoder()
 
-    dicto = {}
+    with open(path) as f:
+        buffer = f.read(buffer_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError("{} does not contain a JSON array".format(path))
+        pos = 1
 
-    for sty, concepts in stys.items():
+        while True:
+            pos = _separator.match(buffer, pos).end()
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # The item continues after the buffer.
+                more = f.read(max(buffer_size, len(buffer) - pos))
+                if not more:
+                    raise ValueError("{} ends in the middle of an "
+                                     "item".format(path))
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            yield item
 
-        label = "np"
 
-        if sty in problem:
-            label = "problem"
-        elif sty in test:
-            label = "test"
-        elif sty in treatment:
-            label = "treatment"
+def create_label_table(stys_path, path):
+    """
+    Create a label table from CUIs to labels in a single pass.
+
+    Parameters
+    ==========
+    stys_path : str
+        The path to a JSON array of semantic types, each of which is an
+        object with its identifier as "_id" and its CUIs as "concepts".
+    path : str
+        The directory of the label table. If a CUI has several semantic
+        types, the label of the last one is used.
+
+    """
+    codes = {label: idx for idx, label in enumerate(LABELS)}
+    keys, key_codes = [], []
+
+    for sty in iter_json_array(stys_path):
+        cuis = np.array(sty["concepts"], dtype=bytes)
+        keys.append(cuis)
+        key_codes.append(np.full(len(cuis),
+                                 codes[sty_label(sty["_id"])],
+                                 dtype=np.uint8))
+
+    # Arrays of different widths are padded to the widest.
+    keys = np.concatenate(keys) if keys else np.array([], dtype=bytes)
+    key_codes = (np.concatenate(key_codes) if key_codes
+                 else np.array([], dtype=np.uint8))
+
+    save_label_table(keys, key_codes, LABELS, path)
+
+
+if __name__ == "__main__":
 
-        dicto.update({k: label for k in concepts})
+    create_label_table("data/stys.json", "data/concept_label")
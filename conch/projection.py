@@ -0,0 +1,226 @@
+"""Reduce the dimension of word, phrase and concept vectors."""
+import os
+import time
+import numpy as np
+
+from reach import Reach
+
+from conch.embeddings import reach_from_arrays, _dump_json
+
+
+def fit_projection(vectors, dim, method="pca", seed=0, sample_size=100000):
+    """
+    Fit a linear projection to a lower dimension.
+
+    With norm=False, composition and concept creation only average the
+    word vectors, so a linear projection can then be applied to the word
+    embeddings before composing, or to the phrase and concept vectors
+    afterwards, with the same result. With norm=True this does not hold,
+    because the unit vectors of the projected word embeddings are not the
+    projections of the unit vectors; project the phrases and concepts
+    after composing instead. Zero vectors, e.g. of OOV phrases, stay zero.
+
+    Parameters
+    ==========
+    vectors : np.array
+        The vectors to fit the projection on, e.g. the word embeddings or
+        the concept vectors.
+    dim : int
+        The dimension to project to.
+    method : str, optional, default "pca"
+        Either "pca", for the top dim principal axes of the vectors, or
+        "random", for a seeded gaussian random projection. The principal
+        axes are found without centering the vectors, so the dot products
+        on which the search is based are kept as well as possible.
+    seed : int, optional, default 0
+        The random seed, for the projection or the sample.
+    sample_size : int, optional, default 100000
+        The principal axes are fit on a random sample of at most this many
+        vectors.
+
+    Returns
+    =======
+    projection : np.array
+        A matrix of shape (vectors.shape[1], dim).
+
+    """
+    size = vectors.shape[1]
+    if not 0 < dim <= size:
+        raise ValueError("dim should be between 1 and {}, "
+                         "got {}".format(size, dim))
+
+    rng = np.random.RandomState(seed)
+
+    if method == "random":
+        projection = rng.standard_normal((size, dim)) / np.sqrt(dim)
+    elif method == "pca":
+        if len(vectors) > sample_size:
+            rows = np.sort(rng.choice(len(vectors), sample_size, False))
+            vectors = vectors[rows]
+        sample = np.asarray(vectors, dtype=np.float64)
+        _, _, components = np.linalg.svd(sample, full_matrices=False)
+        projection = components[:dim].T
+    else:
+        raise ValueError("method should be 'pca' or 'random', "
+                         "got {}".format(method))
+
+    return projection.astype(np.float32)
+
+
+def save_projection(projection, path):
+    """Save a projection as an .npy file, and move it into place."""
+    tmp = "{}.{}.tmp.npy".format(path, os.getpid())
+    np.save(tmp, projection)
+    os.replace(tmp, path)
+
+
+def load_projection(path):
+    """Load a projection saved with save_projection."""
+    return np.load(path)
+
+
+def project(r, projection, batch_size=100000):
+    """
+    Project the vectors of a Reach instance.
+
+    Parameters
+    ==========
+    r : Reach
+        The vectors to project, e.g. word embeddings, phrases or concepts.
+    projection : np.array
+        A projection from fit_projection.
+    batch_size : int, optional, default 100000
+        The number of vectors which are projected at the same time.
+
+    Returns
+    =======
+    projected : Reach
+        A reach instance with the same items and the projected vectors.
+
+    """
+    num = len(r.vectors)
+    dtype = np.result_type(r.vectors.dtype, projection.dtype)
+    vectors = np.empty((num, projection.shape[1]), dtype=dtype)
+    norm_vectors = np.empty_like(vectors)
+    for begin in range(0, num, batch_size):
+        batch = r.vectors[begin:begin+batch_size]
+        vectors[begin:begin+batch_size] = batch.dot(projection)
+        norm_vectors[begin:begin+batch_size] = Reach.normalize(
+            vectors[begin:begin+batch_size])
+
+    words = [r.indices[x] for x in range(num)]
+    unk_word = None if r.unk_index is None else r.indices[r.unk_index]
+
+    return reach_from_arrays(vectors, norm_vectors, words, unk_word, r.name)
+
+
+def compare_projection(phrases,
+                       concepts,
+                       labels,
+                       projection,
+                       batch_size=250,
+                       n_jobs=1):
+    """
+    Compare labelling in the full and in the projected space.
+
+    The phrases and concepts are labelled with eval_extrinsic_label in
+    both spaces, and the throughput and the agreement between the labels
+    are printed.
+
+    Parameters
+    ==========
+    phrases : Reach
+        The composed phrases, in the full space.
+    concepts : Reach
+        The concept vectors, in the full space.
+    labels : dict or LabelTable
+        A mapping from concept names to labels.
+    projection : np.array
+        A projection from fit_projection.
+    batch_size : int, optional, default 250
+        The batch size to use.
+    n_jobs : int, optional, default 1
+        The number of threads over which the batches are divided.
+
+    Returns
+    =======
+    report : dict
+        The dimensions, the labelling time and throughput in phrases per
+        second in each space, and the fraction of phrases which get the
+        same label in both spaces.
+
+    """
+    from conch.evaluation.extrinsic import eval_extrinsic_label
+
+    start = time.time()
+    full = eval_extrinsic_label(phrases,
+                                concepts,
+                                labels,
+                                batch_size,
+                                n_jobs=n_jobs)
+    full_time = time.time() - start
+
+    phrases = project(phrases, projection)
+    concepts = project(concepts, projection)
+
+    start = time.time()
+    reduced = eval_extrinsic_label(phrases,
+                                   concepts,
+                                   labels,
+                                   batch_size,
+                                   n_jobs=n_jobs)
+    reduced_time = time.time() - start
+
+    num = len(full)
+    agreement = sum(a == b for a, b in zip(full, reduced)) / max(num, 1)
+    report = {"full_dim": projection.shape[0],
+              "reduced_dim": projection.shape[1],
+              "full_time": full_time,
+              "reduced_time": reduced_time,
+              "full_throughput": num / max(full_time, 1e-9),
+              "reduced_throughput": num / max(reduced_time, 1e-9),
+              "agreement": agreement}
+
+    print("Dimension {} to {}: {:.0f} to {:.0f} phrases per second, "
+          "label agreement {:.3f}".format(report["full_dim"],
+                                          report["reduced_dim"],
+                                          report["full_throughput"],
+                                          report["reduced_throughput"],
+                                          agreement))
+
+    return report
+
+
+if __name__ == "__main__":
+
+    from conch.conch import compose, reciprocal
+    from conch.corpus import Corpus
+    from conch.embeddings import load_pruned, corpus_vocabulary
+    from conch.label_table import LabelTable
+
+    data = Corpus("data/test_uima")
+    embeddings = load_pruned("",
+                             corpus_vocabulary(data),
+                             unk_word="UNK")
+    concept_reach = Reach.load_fast_format("data/concept_vectors")
+    concept_labels = LabelTable("data/names2label")
+
+    phrases = compose(data,
+                      window=0,
+                      embeddings=embeddings,
+                      context_function=reciprocal)
+
+    reports = []
+    for method in ("pca", "random"):
+        for dim in (25, 50, 100):
+            projection = fit_projection(concept_reach.vectors, dim, method)
+            save_projection(projection,
+                            "data/projection_{}_{}.npy".format(method, dim))
+            report = compare_projection(phrases,
+                                        concept_reach,
+                                        concept_labels,
+                                        projection)
+            report["method"] = method
+            reports.append(report)
+
+    _dump_json(reports, "results/projection.json")
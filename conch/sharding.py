@@ -0,0 +1,461 @@
+"""
+Sharded processing of a corpus over several processes or nodes.
+
+The corpus is split by document into shards, which are listed in a
+manifest. Any process which can see the manifest directory, e.g. on a
+shared filesystem, can claim a shard, compose its phrases and label them
+with concepts. The outputs of all shards are then merged in shard order,
+which gives the same result regardless of which worker processed which
+shard.
+
+Usage:
+
+    python -m conch.sharding work path/to/manifest.json [max_age]
+    python -m conch.sharding merge path/to/manifest.json
+"""
+import json
+import os
+import socket
+import sys
+import time
+import uuid
+import numpy as np
+
+from multiprocessing import Process
+from reach import Reach
+
+from conch import conch
+from conch.corpus import Corpus
+from conch.embeddings import load_embeddings
+from conch.label_table import LabelTable
+from conch.evaluation.extrinsic import eval_extrinsic
+
+
+def create_manifest(corpus_path,
+                    out_dir,
+                    num_shards,
+                    embeddings_path,
+                    concepts_path,
+                    labels_path,
+                    window=0,
+                    context_function="reciprocal",
+                    use_focus=True,
+                    norm=False,
+                    unk_word="UNK",
+                    batch_size=250):
+    """
+    Split a corpus into shards and write a manifest.
+
+    Parameters
+    ==========
+    corpus_path : str
+        The path to a corpus written by save_corpus, e.g. data/test_uima,
+        or to a JSON file containing a dictionary mapping from document
+        keys to (tokens, bio) tuples.
+    out_dir : str
+        The directory to which the manifest and all shard outputs are
+        written.
+    num_shards : int
+        The number of shards.
+    embeddings_path : str
+        The path to the word vectors, which are loaded with
+        load_embeddings.
+    concepts_path : str
+        The prefix of the concept vectors in reach fast format.
+    labels_path : str
+        The path to a label table, or to a JSON file mapping from concept
+        names to labels.
+    window : int, optional, default 0
+        The window size to use.
+    context_function : str, optional, default "reciprocal"
+        The name of the context function in conch.conch.
+    use_focus : bool, optional, default True
+        Whether to vectorize the focus word.
+    norm : bool, optional, default False
+        Whether to use the unit vectors to compose.
+    unk_word : str, optional, default "UNK"
+        The item which is used for out of vocabulary words.
+    batch_size : int, optional, default 250
+        The batch size to use during labelling.
+
+    Returns
+    =======
+    manifest_path : str
+        The path to the manifest.
+
+    """
+    corpus = _open_corpus(corpus_path)
+    keys = sorted(corpus.keys if isinstance(corpus, Corpus) else corpus)
+    del corpus
+    if not keys:
+        raise ValueError("The corpus at {} contains no "
+                         "documents".format(corpus_path))
+    size = -(-len(keys) // num_shards)
+    shards = [keys[x:x+size] for x in range(0, len(keys), size)]
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    manifest = {"corpus": os.path.abspath(corpus_path),
+                "shards": shards,
+                "settings": {"embeddings": os.path.abspath(embeddings_path),
+                             "concepts": os.path.abspath(concepts_path),
+                             "labels": os.path.abspath(labels_path),
+                             "window": window,
+                             "context_function": context_function,
+                             "use_focus": use_focus,
+                             "norm": norm,
+                             "unk_word": unk_word,
+                             "batch_size": batch_size}}
+
+    manifest_path = os.path.join(out_dir, "manifest.json")
+    json.dump(manifest, open(manifest_path, 'w'))
+
+    return manifest_path
+
+
+def _open_corpus(corpus_path):
+    """Open a corpus directory, or load a JSON corpus as a dictionary."""
+    if os.path.isdir(corpus_path):
+        return Corpus(corpus_path)
+    return json.load(open(corpus_path))
+
+
+def _open_labels(labels_path):
+    """Open a label table directory, or load a JSON file of labels."""
+    if os.path.isdir(labels_path):
+        return LabelTable(labels_path)
+    return json.load(open(labels_path))
+
+
+def _shard_path(manifest_path, shard_id, suffix):
+    """Get the path of a shard output file."""
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+    return os.path.join(directory, "shard_{}_{}".format(shard_id, suffix))
+
+
+def claim(manifest_path, shard_id, max_age=None):
+    """
+    Try to claim a shard for processing.
+
+    The claim is made by atomically creating a lock file, which works
+    across processes and nodes on a shared filesystem. The lock file
+    records when the shard was claimed, so that the lock of a worker
+    which died before finishing its shard can be reclaimed.
+
+    Parameters
+    ==========
+    manifest_path : str
+        The path to the manifest.
+    shard_id : int
+        The shard to claim.
+    max_age : float, optional, default None
+        The number of seconds after which the lock of an unfinished shard
+        is considered stale, and the shard can be claimed again. This
+        should be well above the time it takes to process a shard. If
+        this is None, locks are never reclaimed.
+
+    Returns
+    =======
+    claimed : bool
+        True if this process now owns the shard.
+
+    """
+    lock = _shard_path(manifest_path, shard_id, "lock")
+    if _create_lock(lock):
+        return True
+    if max_age is None or is_done(manifest_path, shard_id):
+        return False
+
+    lease = _read_lock(lock)
+    if lease is None or time.time() - lease["time"] < max_age:
+        return False
+
+    # Move the stale lock out of the way. Only one process can move it,
+    # but it might have been replaced by a fresh lock in the meantime, in
+    # which case that lock is put back.
+    stale = "{}.stale.{}".format(lock, uuid.uuid4().hex)
+    try:
+        os.rename(lock, stale)
+    except OSError:
+        return False
+    if _read_lock(stale) != lease:
+        try:
+            os.link(stale, lock)
+        except OSError:
+            pass
+        os.remove(stale)
+        return False
+    os.remove(stale)
+
+    print("Reclaiming shard {}, locked by {} at {}".format(shard_id,
+                                                           lease["pid"],
+                                                           lease["time"]))
+    return _create_lock(lock)
+
+
+def _create_lock(lock):
+    """Atomically create a lock file, or return False if it exists."""
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        return False
+    lease = {"pid": os.getpid(),
+             "host": socket.gethostname(),
+             "time": time.time(),
+             "token": uuid.uuid4().hex}
+    os.write(fd, json.dumps(lease).encode("utf-8"))
+    os.close(fd)
+
+    return True
+
+
+def _read_lock(lock):
+    """
+    Read the lease in a lock file.
+
+    Returns None if the lock file does not exist, or is still being
+    written.
+
+    """
+    try:
+        with open(lock) as f:
+            lease = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(lease, dict):
+        return None
+    return lease
+
+
+def is_done(manifest_path, shard_id):
+    """Check whether a shard has been processed completely."""
+    return os.path.exists(_shard_path(manifest_path, shard_id, "done"))
+
+
+def process_shard(manifest_path, shard_id, embeddings=None, concepts=None):
+    """
+    Compose and label the documents of a single shard.
+
+    Writes the phrase vectors, phrase names and labelled BIO sequences of
+    the shard next to the manifest. A done marker is written last, so that
+    partial outputs are never merged.
+
+    Parameters
+    ==========
+    manifest_path : str
+        The path to the manifest.
+    shard_id : int
+        The index of the shard.
+    embeddings : Reach, optional, default None
+        The word vectors. If this is None, they are loaded using the
+        settings in the manifest.
+    concepts : tuple, optional, default None
+        A tuple of the concept Reach and the concept labels. If this is
+        None, they are loaded using the settings in the manifest.
+
+    """
+    manifest = json.load(open(manifest_path))
+    settings = manifest["settings"]
+    keys = manifest["shards"][shard_id]
+
+    if embeddings is None:
+        embeddings = load_embeddings(settings["embeddings"],
+                                     unk_word=settings["unk_word"])
+    if concepts is None:
+        concepts = (Reach.load_fast_format(settings["concepts"]),
+                    _open_labels(settings["labels"]))
+    concept_reach, concept_labels = concepts
+
+    corpus = _open_corpus(manifest["corpus"])
+    documents = [corpus[k] for k in keys]
+    del corpus
+
+    if not any(x.startswith("B") for _, bio in documents for x in bio):
+        # compose can not create a space without phrases, but a shard
+        # of short documents may not contain any chunks.
+        bio = {key: ["O"] * len(txt)
+               for key, (txt, _) in zip(keys, documents)}
+        vectors = np.zeros((0, embeddings.size),
+                           dtype=embeddings.vectors.dtype)
+        _save_shard(manifest_path, shard_id, vectors, [], bio)
+        return
+
+    phrases = conch.compose(documents,
+                            embeddings=embeddings,
+                            window=settings["window"],
+                            context_function=getattr(
+                                conch, settings["context_function"]),
+                            use_focus=settings["use_focus"],
+                            norm=settings["norm"])
+
+    # Labelled per document, so chunks never run into the next document,
+    # and the result does not depend on the shards.
+    new_bio = eval_extrinsic([bio for _, bio in documents],
+                             phrases,
+                             concept_reach,
+                             concept_labels,
+                             settings["batch_size"])
+
+    # Split the labelled BIO sequence back into documents.
+    bio = {}
+    offset = 0
+    for key, (txt, _) in zip(keys, documents):
+        bio[key] = new_bio[offset:offset+len(txt)]
+        offset += len(txt)
+
+    names = [phrases.indices[x] for x in range(len(phrases.indices))]
+    _save_shard(manifest_path, shard_id, phrases.vectors, names, bio)
+
+
+def _save_shard(manifest_path, shard_id, vectors, names, bio):
+    """Save the outputs of a shard, and mark it as done."""
+    _atomic_save(_shard_path(manifest_path, shard_id, "vectors.npy"),
+                 lambda f: np.save(f, vectors))
+    _atomic_save(_shard_path(manifest_path, shard_id, "phrases.json"),
+                 lambda f: f.write(json.dumps(names).encode("utf-8")))
+    _atomic_save(_shard_path(manifest_path, shard_id, "bio.json"),
+                 lambda f: f.write(json.dumps(bio).encode("utf-8")))
+    open(_shard_path(manifest_path, shard_id, "done"), 'w').close()
+
+
+def _atomic_save(path, write):
+    """Write to a temporary file, and move it into place when done."""
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def work(manifest_path, max_age=None):
+    """
+    Process shards until no unclaimed shards are left.
+
+    This is the entry point for a worker. It can be started on as many
+    processes and nodes as needed. The embeddings and concepts are only
+    loaded once per worker.
+
+    Parameters
+    ==========
+    manifest_path : str
+        The path to the manifest.
+    max_age : float, optional, default None
+        The number of seconds after which the lock of an unfinished shard
+        is reclaimed, see claim. If this is None, shards whose worker died
+        stay locked, and their lock files need to be removed by hand.
+
+    Returns
+    =======
+    processed : list of int
+        The shards processed by this worker.
+
+    """
+    manifest = json.load(open(manifest_path))
+    settings = manifest["settings"]
+    embeddings = concepts = None
+    processed = []
+
+    for shard_id in range(len(manifest["shards"])):
+
+        if is_done(manifest_path, shard_id):
+            continue
+        if not claim(manifest_path, shard_id, max_age):
+            continue
+
+        if embeddings is None:
+            embeddings = load_embeddings(settings["embeddings"],
+                                         unk_word=settings["unk_word"])
+            concepts = (Reach.load_fast_format(settings["concepts"]),
+                        _open_labels(settings["labels"]))
+
+        process_shard(manifest_path, shard_id, embeddings, concepts)
+        processed.append(shard_id)
+
+    return processed
+
+
+def run_local(manifest_path, num_workers, max_age=None):
+    """
+    Process all shards with several local processes standing in for nodes.
+
+    Parameters
+    ==========
+    manifest_path : str
+        The path to the manifest.
+    num_workers : int
+        The number of worker processes.
+    max_age : float, optional, default None
+        The number of seconds after which stale locks are reclaimed.
+
+    """
+    workers = [Process(target=work, args=(manifest_path, max_age))
+               for _ in range(num_workers)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+
+def merge(manifest_path):
+    """
+    Merge the outputs of all shards.
+
+    The shards are merged in order, and each phrase is renumbered by its
+    position in the merged space, so the result is the same as composing
+    the whole corpus at once.
+
+    Parameters
+    ==========
+    manifest_path : str
+        The path to the manifest.
+
+    Returns
+    =======
+    phrases : Reach
+        A reach instance containing all phrases and their vectors.
+    bio : dict
+        A dictionary mapping from document keys to labelled BIO sequences.
+
+    """
+    manifest = json.load(open(manifest_path))
+    num_shards = len(manifest["shards"])
+
+    missing = [x for x in range(num_shards)
+               if not is_done(manifest_path, x)]
+    if missing:
+        raise ValueError("Not all shards are done: {}".format(missing))
+
+    vectors, names, bio = [], [], {}
+    for shard_id in range(num_shards):
+        vectors.append(np.load(_shard_path(manifest_path,
+                                           shard_id,
+                                           "vectors.npy")))
+        for name in json.load(open(_shard_path(manifest_path,
+                                               shard_id,
+                                               "phrases.json"))):
+            # Replace the index within the shard by the global index.
+            name = name.rsplit("-", 1)[0]
+            names.append("{}-{}".format(name, len(names)))
+        bio.update(json.load(open(_shard_path(manifest_path,
+                                              shard_id,
+                                              "bio.json"))))
+
+    # Shards without phrases are kept, so an empty result still has the
+    # dimension of the embeddings.
+    return Reach(np.concatenate(vectors), names), bio
+
+
+if __name__ == "__main__":
+
+    command, manifest_path = sys.argv[1:3]
+
+    if command == "work":
+        max_age = float(sys.argv[3]) if len(sys.argv) > 3 else None
+        print("Processed shards: {}".format(work(manifest_path, max_age)))
+    elif command == "merge":
+        phrases, bio = merge(manifest_path)
+        directory = os.path.dirname(os.path.abspath(manifest_path))
+        phrases.save_fast_format(os.path.join(directory, "phrases"))
+        json.dump(bio, open(os.path.join(directory, "bio.json"), 'w'))
+    else:
+        raise ValueError("Unknown command: {}".format(command))
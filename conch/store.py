@@ -0,0 +1,349 @@
+"""An append-only store of composed phrases."""
+import json
+import os
+import numpy as np
+
+from reach import Reach
+
+from conch import conch
+from conch.embeddings import _dump_json
+
+
+class PhraseStore(object):
+    """
+    Persistent, append-only store of composed phrases.
+
+    Each phrase gets an id when it is added, which is its position in the
+    store, and which never changes afterwards. New documents can be added
+    at any time: only their phrases are composed, and the phrases and
+    labels of earlier documents are reused.
+
+    The store is a directory, which contains the composition settings,
+    and one segment per call to add. A segment holds the vectors and spans
+    of the added phrases, the keys of the added documents, and the label
+    code of each phrase, which is -1 until the phrase is labelled. The
+    labels belonging to the codes are shared by all segments.
+
+    Parameters
+    ==========
+    path : str
+        The directory of the store. It is created if it does not exist.
+    window : int, optional, default 0
+        The window size to use.
+    context_function : str, optional, default "reciprocal"
+        The name of the context function in conch.conch.
+    use_focus : bool, optional, default True
+        Whether to vectorize the focus word.
+    norm : bool, optional, default False
+        Whether to use the unit vectors to compose.
+
+    """
+
+    def __init__(self,
+                 path,
+                 window=0,
+                 context_function="reciprocal",
+                 use_focus=True,
+                 norm=False):
+        """Open a store, or create it if it does not exist."""
+        self.path = path
+        self.settings = {"window": window,
+                         "context_function": context_function,
+                         "use_focus": use_focus,
+                         "norm": norm}
+
+        settings_path = os.path.join(path, "settings.json")
+        if os.path.exists(settings_path):
+            stored = json.load(open(settings_path))
+            if stored["settings"] != self.settings:
+                raise ValueError("The store at {} was created with different "
+                                 "settings: {}".format(path,
+                                                       stored["settings"]))
+            self.num_segments = stored["num_segments"]
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.num_segments = 0
+            self._save_settings()
+
+        self.spans = []
+        self.names = []
+        self.documents = set()
+        # The first id of each segment, and the number of phrases.
+        self.offsets = [0]
+        # The range of ids of each document, which are consecutive.
+        self._ranges = {}
+        self._codes = []
+        for segment in range(self.num_segments):
+            spans = json.load(open(self._segment_path(segment,
+                                                      "spans.json")))
+            self._add_spans(spans)
+            self.documents.update(json.load(
+                open(self._segment_path(segment, "documents.json"))))
+            self._codes.append(np.load(self._segment_path(segment,
+                                                          "labels.npy")))
+
+        labels_path = os.path.join(path, "labels.json")
+        if os.path.exists(labels_path):
+            self._label_names = json.load(open(labels_path))
+        else:
+            self._label_names = []
+
+    def __len__(self):
+        """Get the number of phrases in the store."""
+        return len(self.spans)
+
+    def _segment_path(self, segment, suffix):
+        """Get the path of a segment file."""
+        return os.path.join(self.path,
+                            "segment_{}_{}".format(segment, suffix))
+
+    def _add_spans(self, spans):
+        """Add the spans of a segment to the in-memory index."""
+        start = len(self.spans)
+        for idx, (key, begin, end, name) in enumerate(spans, start):
+            first, _ = self._ranges.get(key, (idx, idx))
+            self._ranges[key] = (first, idx + 1)
+            self.spans.append((key, begin, end))
+            self.names.append(name)
+        self.offsets.append(len(self.spans))
+
+    def _save_settings(self):
+        """Write the settings, and the number of segments."""
+        _dump_json({"settings": self.settings,
+                    "num_segments": self.num_segments},
+                   os.path.join(self.path, "settings.json"))
+
+    def add(self, documents, embeddings, cache_size=None):
+        """
+        Compose and add the phrases of new documents.
+
+        Documents whose key is already in the store are skipped.
+
+        Parameters
+        ==========
+        documents : dict
+            A dictionary mapping from document keys to (tokens, bio)
+            tuples.
+        embeddings : Reach
+            The word embeddings. Should be the same for every call.
+        cache_size : int, optional, default None
+            The size of the phrase cache, see compose.
+
+        Returns
+        =======
+        ids : np.array
+            The ids of the added phrases.
+
+        """
+        keys = sorted(k for k in documents if k not in self.documents)
+        start = len(self)
+        if not keys:
+            return np.arange(start, start)
+
+        spans, vectors = [], []
+        context_function = getattr(conch, self.settings["context_function"])
+        phrases = conch.iter_phrases([documents[k] for k in keys],
+                                     embeddings,
+                                     self.settings["window"],
+                                     context_function,
+                                     self.settings["use_focus"],
+                                     self.settings["norm"],
+                                     cache_size)
+
+        for idx, begin, end, phrase_string, vector in phrases:
+            # The id is the position in the store, like in compose.
+            name = "{}-{}".format(phrase_string, start + len(spans))
+            spans.append((keys[idx], begin, end, name))
+            vectors.append(vector)
+
+        segment = self.num_segments
+        vectors = np.array(vectors).reshape(len(spans), embeddings.size)
+        codes = np.full(len(spans), -1, dtype=np.int32)
+        np.save(self._segment_path(segment, "vectors.npy"), vectors)
+        np.save(self._segment_path(segment, "labels.npy"), codes)
+        _dump_json(spans, self._segment_path(segment, "spans.json"))
+        # Documents without phrases are stored as well, so they are not
+        # composed again.
+        _dump_json(keys, self._segment_path(segment, "documents.json"))
+
+        # The segment only becomes part of the store when the settings
+        # are updated, so a crash during add leaves the store intact.
+        self.num_segments += 1
+        self._save_settings()
+
+        self._add_spans(spans)
+        self._codes.append(codes)
+        self.documents.update(keys)
+
+        return np.arange(start, len(self))
+
+    def _segments(self, ids):
+        """
+        Group ids by the segment they are in.
+
+        Returns
+        =======
+        groups : generator
+            A (segment, positions, rows) tuple for each segment, where
+            positions are the positions in ids of the phrases in the
+            segment, and rows their rows within the segment.
+
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) and (ids.min() < 0 or ids.max() >= len(self)):
+            raise ValueError("ids should be between 0 and {}".format(
+                len(self) - 1))
+        segments = np.searchsorted(self.offsets, ids, side="right") - 1
+        order = np.argsort(segments, kind="stable")
+        bounds = np.searchsorted(segments[order],
+                                 np.arange(self.num_segments + 1))
+        for segment in range(self.num_segments):
+            positions = order[bounds[segment]:bounds[segment + 1]]
+            if len(positions):
+                rows = ids[positions] - self.offsets[segment]
+                yield segment, positions, rows
+
+    def vectors(self, ids=None):
+        """
+        Get the vectors of phrases.
+
+        Only the rows which are needed are read from each segment.
+
+        Parameters
+        ==========
+        ids : list of int, optional, default None
+            The ids of the phrases. If this is None, all phrases are
+            returned in the order of their ids.
+
+        Returns
+        =======
+        vectors : np.array
+            The vector of each phrase.
+
+        """
+        segments = [np.load(self._segment_path(x, "vectors.npy"),
+                            mmap_mode="r")
+                    for x in range(self.num_segments)]
+        if ids is None:
+            segments = [x for x in segments if len(x)]
+            if not segments:
+                return np.zeros((0, 0))
+            return np.concatenate(segments)
+
+        vectors = None
+        for segment, positions, rows in self._segments(ids):
+            segment = segments[segment]
+            if vectors is None:
+                vectors = np.empty((len(ids), segment.shape[1]),
+                                   dtype=segment.dtype)
+            vectors[positions] = segment[rows]
+        if vectors is None:
+            return np.zeros((0, 0))
+
+        return vectors
+
+    def reach(self):
+        """Get a Reach instance of all phrases, indexed by their ids."""
+        return Reach(self.vectors(), self.names)
+
+    def ids(self, key):
+        """Get the ids of the phrases of a document."""
+        return list(range(*self._ranges.get(key, (0, 0))))
+
+    def labels(self, ids=None):
+        """
+        Get the stored labels of phrases.
+
+        Parameters
+        ==========
+        ids : list of int, optional, default None
+            The ids of the phrases. If this is None, all phrases are used.
+
+        Returns
+        =======
+        labels : list
+            The label of each phrase, or None if it has not been labelled.
+
+        """
+        if ids is None:
+            codes = (np.concatenate(self._codes) if self._codes
+                     else np.zeros(0, dtype=np.int32))
+        else:
+            codes = np.empty(len(ids), dtype=np.int32)
+            for segment, positions, rows in self._segments(ids):
+                codes[positions] = self._codes[segment][rows]
+
+        names = self._label_names + [None]
+        return [names[x] for x in codes.tolist()]
+
+    def unlabeled(self):
+        """Get the ids of all phrases which have not been labelled."""
+        ids = [np.flatnonzero(codes < 0) + offset
+               for codes, offset in zip(self._codes, self.offsets)]
+        if not ids:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(ids).astype(np.int64)
+
+    def set_labels(self, ids, labels):
+        """
+        Store the labels of a set of phrases.
+
+        Only the label codes of the segments which contain the phrases are
+        rewritten.
+
+        Parameters
+        ==========
+        ids : list of int
+            The ids of the phrases.
+        labels : list of str
+            The label of each phrase.
+
+        """
+        label_codes = {x: idx for idx, x in enumerate(self._label_names)}
+        num_labels = len(label_codes)
+        codes = np.array([label_codes.setdefault(x, len(label_codes))
+                          for x in labels], dtype=np.int32)
+        if len(label_codes) > num_labels:
+            # New labels are written before the codes which refer to them.
+            self._label_names = sorted(label_codes, key=label_codes.get)
+            _dump_json(self._label_names,
+                       os.path.join(self.path, "labels.json"))
+
+        for segment, positions, rows in self._segments(ids):
+            segment_codes = self._codes[segment].copy()
+            segment_codes[rows] = codes[positions]
+            path = self._segment_path(segment, "labels.npy")
+            tmp = "{}.{}.tmp.npy".format(path, os.getpid())
+            np.save(tmp, segment_codes)
+            os.replace(tmp, path)
+            self._codes[segment] = segment_codes
+
+    def label(self, concepts, concept_labels, batch_size=250):
+        """
+        Label all phrases which have not been labelled yet.
+
+        See eval_extrinsic_label for the parameters.
+
+        Returns
+        =======
+        ids : np.array
+            The ids of the newly labelled phrases.
+
+        """
+        from conch.evaluation.extrinsic import eval_extrinsic_label
+
+        ids = self.unlabeled()
+        if not len(ids):
+            return ids
+
+        vectors = self.vectors(ids)
+        phrases = Reach(vectors, [self.names[x] for x in ids])
+        labels = eval_extrinsic_label(phrases,
+                                      concepts,
+                                      concept_labels,
+                                      batch_size)
+        self.set_labels(ids, labels)
+
+        return ids
+
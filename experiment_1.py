@@ -6,13 +6,15 @@ Because of the low run-time for these experiments, we run both the Perfect
 and parsed experiments at the same time.
 """
 import json
+import numpy as np
 
 from conch.evaluation.intrinsic import evaluate_intrinsic
 from conch.evaluation.utils import evaluate_k
-from reach import Reach
+from conch.evaluation.knn import save_knn
+from conch.embeddings import load_pruned, corpus_vocabulary
+from conch.corpus import Corpus
 from conch.conch import compose, reciprocal
 from conch.preprocessing.baseline import baseline
-from itertools import chain
 
 
 def experiment(parsed,
@@ -23,8 +25,6 @@ def experiment(parsed,
                k,
                use_focus=True):
     """Run an experiment with intrinsic evaluation."""
-    _, np_chunks = zip(*parsed)
-
     phrase_embeddings = compose(parsed,
                                 window=window,
                                 embeddings=embeddings,
@@ -33,9 +33,10 @@ def experiment(parsed,
                                 norm=True)
 
     result = evaluate_intrinsic(gold_chunks,
-                                np_chunks,
+                                parsed,
                                 phrase_embeddings,
-                                k=k)
+                                k=k,
+                                encoded=True)
 
     return result
 
@@ -44,19 +45,19 @@ if __name__ == "__main__":
 
     scores = {}
 
-    gold = json.load(open("data/beth_gold.json"))
-    gold = list(zip(*sorted(gold.items())))[1]
-
-    txt, gold_chunks = zip(*gold)
+    gold = Corpus("data/beth_gold")
+    gold_chunks = gold
 
-    data = json.load(open("data/beth_uima.json"))
-    data = list(zip(*sorted(data.items())))[1]
+    data = Corpus("data/beth_uima")
 
     # Sanity check
-    for a, b in zip(data, gold):
-        assert len(a[0]) == len(b[0])
+    assert data.keys == gold.keys
+    assert np.array_equal(data.lengths(), gold.lengths())
 
-    embeddings = Reach.load("", unk_word="UNK")
+    embeddings = load_pruned("",
+                             corpus_vocabulary(data) |
+                             corpus_vocabulary(gold),
+                             unk_word="UNK")
 
     scores = {}
 
@@ -109,12 +110,9 @@ if __name__ == "__main__":
                                  use_focus=False)
 
     # Baseline space with 10000 words.
-    txt = list(chain.from_iterable(txt))
+    txt = gold.all_tokens()
     embeddings = baseline(txt, 10000)
 
-    for a, b in zip(data, gold):
-        assert len(a[0]) == len(b[0])
-
     baseline = experiment(data,
                           gold_chunks,
                           embeddings,
@@ -144,8 +142,8 @@ if __name__ == "__main__":
 
     for k, v in scores_knn.items():
 
-        t, p = zip(*v)
-        scores[k] = evaluate_k(t, p, None)
+        labels, gold_labels, neighbors = v
+        save_knn("knn_intrinsic_norm_{}.npz".format(k), v)
+        scores[k] = evaluate_k(gold_labels, neighbors, None)
 
     json.dump(scores, open("scores_intrinsic_norm.json", 'w'))
-    json.dump(scores_knn, open("knn_intrinsic_norm.json", 'w'))
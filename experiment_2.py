@@ -4,13 +4,15 @@ Run transfer experiments.
 Running this file will replicate experiment 2 from the paper.
 """
 import json
+import numpy as np
 
 from conch.evaluation.intrinsic import evaluate_transfer
-from reach import Reach
+from conch.embeddings import load_pruned, corpus_vocabulary
+from conch.corpus import Corpus
 from conch.conch import compose, reciprocal
 from conch.evaluation.utils import evaluate_k
+from conch.evaluation.knn import save_knn
 from conch.preprocessing.baseline import baseline
-from itertools import chain
 
 
 def experiment(parsed_train,
@@ -23,9 +25,6 @@ def experiment(parsed_train,
                k,
                use_focus=True):
     """Run an experiment with transfer evaluation."""
-    _, np_chunks_train = zip(*parsed_train)
-    _, np_chunks_test = zip(*parsed_test)
-
     phrase_embeddings_train = compose(parsed_train,
                                       window=window,
                                       embeddings=embeddings,
@@ -39,12 +38,13 @@ def experiment(parsed_train,
                                      use_focus=use_focus)
 
     result = evaluate_transfer(gold_chunks_train,
-                               np_chunks_train,
+                               parsed_train,
                                gold_chunks_test,
-                               np_chunks_test,
+                               parsed_test,
                                phrase_embeddings_train,
                                phrase_embeddings_test,
-                               k=k)
+                               k=k,
+                               encoded=True)
 
     return result
 
@@ -52,28 +52,18 @@ def experiment(parsed_train,
 if __name__ == "__main__":
 
     scores = {}
-    parsed_train = json.load(open("data/partners_uima.json"))
-    parsed_train = list(zip(*sorted(parsed_train.items())))[1]
-
-    gold_train = json.load(open("data/partners_gold.json"))
-    gold_train = list(zip(*sorted(gold_train.items())))[1]
-
-    parsed_test = json.load(open("data/beth_uima.json"))
-    parsed_test = list(zip(*sorted(parsed_test.items())))[1]
-
-    gold_test = json.load(open("data/beth_gold.json"))
-    gold_test = list(zip(*sorted(gold_test.items())))[1]
-
-    txt, gold_chunks_train = zip(*gold_train)
-    _, gold_chunks_test = zip(*gold_test)
+    parsed_train = Corpus("data/partners_uima")
+    gold_chunks_train = Corpus("data/partners_gold")
 
-    embeddings = Reach.load("")
+    parsed_test = Corpus("data/beth_uima")
+    gold_chunks_test = Corpus("data/beth_gold")
 
-    for a, b in zip(parsed_train, gold_train):
-        assert len(a[0]) == len(b[0])
+    embeddings = load_pruned("",
+                             corpus_vocabulary(parsed_train) |
+                             corpus_vocabulary(parsed_test))
 
-    for a, b in zip(parsed_test, gold_test):
-        assert len(a[0]) == len(b[0])
+    assert np.array_equal(parsed_train.lengths(), gold_chunks_train.lengths())
+    assert np.array_equal(parsed_test.lengths(), gold_chunks_test.lengths())
 
     knn_focus = experiment(parsed_train,
                            gold_chunks_train,
@@ -106,7 +96,7 @@ if __name__ == "__main__":
                              use_focus=False)
 
     # Baseline space with 10000 words.
-    txt = list(chain.from_iterable(txt))
+    txt = gold_chunks_train.all_tokens()
     embeddings = baseline(txt, 10000)
 
     baseline = experiment(parsed_train,
@@ -128,8 +118,8 @@ if __name__ == "__main__":
 
     for k, v in scores_knn.items():
 
-        t, p = zip(*v)
-        scores[k] = evaluate_k(t, p, None)
+        labels, gold_labels, neighbors = v
+        save_knn("knn_transfer_{}.npz".format(k), v)
+        scores[k] = evaluate_k(gold_labels, neighbors, None)
 
     json.dump(scores, open("scores_transfer.json", 'w'))
-    json.dump(scores_knn, open("knn_transfer.json", 'w'))
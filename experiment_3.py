@@ -6,10 +6,12 @@ Set the boolean flag Perfect to True if you want to try perfect chunking.
 """
 import json
 
-from itertools import chain
 from conch.evaluation.extrinsic import eval_extrinsic
 from conch.preprocessing.baseline import baseline
 from conch.preprocessing.concept_vectors import create_concepts
+from conch.embeddings import load_pruned, corpus_vocabulary
+from conch.corpus import Corpus
+from conch.label_table import LabelTable
 from reach import Reach
 from conch.conch import compose, reciprocal
 from conch.evaluation.utils import to_conll
@@ -21,63 +23,70 @@ if __name__ == "__main__":
     # in experiment 3.
     perfect = False
 
-    gold = json.load(open("data/test_gold.json"))
-    gold = list(zip(*sorted(gold.items())))[1]
+    gold = Corpus("data/test_gold")
 
     if perfect:
-        data = json.load(open("data/test_gold.json"))
+        data = Corpus("data/test_gold")
     else:
-        data = json.load(open("data/test_uima.json"))
-    data = list(zip(*sorted(data.items())))[1]
+        data = Corpus("data/test_uima")
 
-    txt, gold_bio = zip(*gold)
-    _, data_bio = zip(*data)
-
-    embeddings = Reach.load("", unk_word="UNK")
+    embeddings = load_pruned("",
+                             corpus_vocabulary(data),
+                             unk_word="UNK")
     concept_reach = Reach.load_fast_format("data/concept_vectors")
-    concept_labels = json.load(open("data/concept_names2label.json"))
+    concept_labels = LabelTable("data/names2label")
+    concepts = json.load(open("data/all_concepts.json"))
 
-    gold_bio = list(chain.from_iterable(gold_bio))
+    gold_bio = gold.all_bio()
 
     results_bio = {}
 
-    r_phrases = compose(data,
-                        window=0,
-                        embeddings=embeddings,
-                        context_function=reciprocal)
+    r_phrases, mask = compose(data,
+                              window=0,
+                              embeddings=embeddings,
+                              context_function=reciprocal,
+                              return_mask=True)
 
-    pred_bio_focus = eval_extrinsic(list(chain.from_iterable(data_bio)),
+    pred_bio_focus = eval_extrinsic(data,
                                     r_phrases,
                                     concept_reach,
                                     concept_labels,
-                                    250)
+                                    250,
+                                    mask=mask)
 
-    r_phrases = compose(data,
-                        window=10,
-                        embeddings=embeddings,
-                        context_function=reciprocal)
+    r_phrases, mask = compose(data,
+                              window=10,
+                              embeddings=embeddings,
+                              context_function=reciprocal,
+                              return_mask=True)
 
-    pred_bio_full = eval_extrinsic(list(chain.from_iterable(data_bio)),
+    pred_bio_full = eval_extrinsic(data,
                                    r_phrases,
                                    concept_reach,
                                    concept_labels,
-                                   250)
+                                   250,
+                                   mask=mask)
 
-    txt = list(chain.from_iterable(txt))
+    txt = gold.all_tokens()
     baseline_embeddings = baseline(txt, 10000)
-    concept_baseline, concept_labels = create_concepts(baseline_embeddings,
-                                                       include_np=True)
-
-    r_phrases = compose(data,
-                        window=0,
-                        embeddings=baseline_embeddings,
-                        context_function=reciprocal)
-
-    pred_bio_baseline = eval_extrinsic(list(chain.from_iterable(data_bio)),
+    concept_baseline = create_concepts(concepts,
+                                       baseline_embeddings,
+                                       include_np=True,
+                                       labels=concept_labels,
+                                       cache_dir="data/cache")
+
+    r_phrases, mask = compose(data,
+                              window=0,
+                              embeddings=baseline_embeddings,
+                              context_function=reciprocal,
+                              return_mask=True)
+
+    pred_bio_baseline = eval_extrinsic(data,
                                        r_phrases,
                                        concept_baseline,
                                        concept_labels,
-                                       250)
+                                       250,
+                                       mask=mask)
 
     json.dump(results_bio, open("results/knn_test_extrinsic.json", 'w'))
 
@@ -0,0 +1,55 @@
+"""
+Measure the cold import time of the extraction path.
+
+Each import is run in a fresh interpreter, so nothing is cached in
+sys.modules. The results are appended to results/import_times.json, so
+they can be tracked over time.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+# The entry points used by short-lived jobs and worker processes.
+TARGETS = {"compose": "from conch.conch import compose",
+           "extrinsic": "from conch.evaluation.extrinsic import "
+                        "eval_extrinsic",
+           "sequence": "from conch.evaluation.sequence import "
+                       "eval_sequence"}
+
+
+def import_time(statement, repeats=5):
+    """Return the fastest wall-clock time of an import in a new process."""
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", statement])
+        times.append(time.time() - start)
+
+    return min(times)
+
+
+def baseline_time(repeats=5):
+    """Return the startup time of an interpreter which imports nothing."""
+    return import_time("pass", repeats)
+
+
+if __name__ == "__main__":
+
+    path = "results/import_times.json"
+
+    startup = baseline_time()
+    record = {"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "python": sys.version.split()[0],
+              "startup": startup}
+
+    for name, statement in sorted(TARGETS.items()):
+        record[name] = import_time(statement) - startup
+        print("{}: {:.3f}s".format(name, record[name]))
+
+    history = []
+    if os.path.exists(path):
+        history = json.load(open(path))
+    history.append(record)
+    json.dump(history, open(path, 'w'), indent=2)